@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of parsing API responses by VkontakteModel.parse().
+Compares current parsing by plan of converters with previous parsing, resolving field for each key,
+and parsing to lightweight records.
+Usage:
+
+    python benchmark.py [--resources 10000]
+"""
+from datetime import datetime, date
+import argparse
+import os
+import sys
+import time
+
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=('django.contrib.contenttypes', 'vkontakte_api'),
+    SOCIAL_API_TOKENS_STORAGES=[],
+)
+
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.utils import timezone
+
+from vkontakte_api.models import VkontakteIDModel
+
+
+class Post(VkontakteIDModel):
+    text = models.TextField()
+    screen_name = models.CharField(max_length=50)
+    date = models.DateTimeField(null=True)
+    birth_date = models.DateField(null=True)
+    likes_count = models.PositiveIntegerField(null=True)
+    views_count = models.IntegerField(null=True)
+    rating = models.FloatField(null=True)
+    attachments = models.CommaSeparatedIntegerField(max_length=100)
+
+    class Meta:
+        app_label = 'vkontakte_api'
+
+
+def parse_previous(self, response):
+    """
+    Previous implementation of VkontakteModel.parse() for JSON-free fields
+    """
+    for key, value in response.items():
+        if key == self.remote_pk_field:
+            key = self.remote_pk_local_field
+            value = int(value)
+
+        try:
+            field = self._meta.get_field(key)
+        except FieldDoesNotExist:
+            continue
+
+        if isinstance(field, models.IntegerField) and value:
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            if isinstance(field, models.PositiveIntegerField):
+                value = value if value > 0 else 0
+        elif isinstance(field, models.FloatField) and value:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        elif isinstance(field, models.CharField):
+            if isinstance(value, bool):
+                value = ''
+            else:
+                try:
+                    value = unicode(value)
+                except:
+                    pass
+        elif isinstance(field, models.DateTimeField):
+            try:
+                value = int(value)
+                assert value > 0
+                value = datetime.utcfromtimestamp(value).replace(tzinfo=timezone.utc)
+            except:
+                value = None
+        elif isinstance(field, models.DateField):
+            try:
+                value = date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+            except:
+                value = None
+
+        if isinstance(field, models.CommaSeparatedIntegerField) and isinstance(value, list):
+            value = ','.join([unicode(v) for v in value])
+
+        setattr(self, key, value)
+
+
+def get_resources(number):
+    return [{
+        'id': i,
+        'text': u'Текст записи %d' % i,
+        'screen_name': 'user%d' % i,
+        'date': 1400000000 + i,
+        'birth_date': '1984-10-10',
+        'likes_count': str(i % 100),
+        'views_count': i * 10,
+        'rating': '4.5',
+        'attachments': '1,2,3',
+        'post_type': 'post',
+        'can_delete': 0,
+        'can_pin': 1,
+    } for i in range(number)]
+
+
+def measure(parse, resources):
+    started = time.time()
+    for resource in resources:
+        parse(Post(), dict(resource))
+    return len(resources) / (time.time() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', type=int, default=10000)
+    args = parser.parse_args()
+
+    resources = get_resources(args.resources)
+    before = measure(parse_previous, resources)
+    after = measure(Post.parse, resources)
+
+    started = time.time()
+    for resource in resources:
+        Post.parse_record(dict(resource))
+    records = len(resources) / (time.time() - started)
+
+    print('Resources parsed per second before: %d' % before)
+    print('Resources parsed per second after: %d' % after)
+    print('Speedup: %.2fx' % (after / before))
+    print('Resources parsed per second to records: %d' % records)
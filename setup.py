@@ -22,6 +22,10 @@ setup(
         'simplejson',
         'beautifulsoup4',
     ],
+    extras_require={
+        'async': ['tornado>=5,<6'],
+        'streaming': ['ijson'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
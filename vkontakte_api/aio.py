@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous client of API and coroutines of VkontakteManager on tornado 5, compatible with python 2.7.
+On python 3 coroutines are executed by asyncio event loop and can be awaited by asyncio code
+"""
+from functools import partial
+import json
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six, timezone
+from django.utils.six.moves.urllib.parse import urlencode
+from social_api.api import NoActiveTokens
+
+from .api import API_URL, VkontakteApiBase, VkontakteError
+from .decorators import atomic
+from .utils import close_connections
+
+try:
+    from tornado import gen, httpclient
+    from tornado.ioloop import IOLoop
+except ImportError:
+    raise ImproperlyConfigured("Package tornado>=5 is required for asynchronous API client")
+
+__all__ = ['api_call', 'AsyncVkontakteApi']
+
+
+class AsyncApi(object):
+    """
+    Asynchronous replacement of vkontakte.API
+    """
+    def __init__(self, token, client, url, timeout):
+        self.token = token
+        self.client = client
+        self.url = url
+        self.timeout = timeout
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, (list, tuple, set)):
+            value = ','.join([six.text_type(v) for v in value])
+        elif isinstance(value, dict):
+            value = json.dumps(value)
+        return six.text_type(value).encode('utf8')
+
+    @gen.coroutine
+    def get(self, method, **kwargs):
+        params = dict([(key, self.encode(value)) for key, value in kwargs.items()])
+        params['access_token'] = self.token
+
+        response = yield self.client.fetch(self.url + method, method='POST', body=urlencode(params),
+                                           request_timeout=self.timeout, raise_error=False)
+        if response.code == 599:
+            # timeout or error of connection
+            raise response.error
+        elif not (200 <= response.code <= 299):
+            raise VkontakteError({
+                'error_code': response.code,
+                'error_msg': "HTTP error",
+                'request_params': kwargs,
+            })
+
+        data = json.loads(response.body.decode('utf8'))
+        if 'error' in data:
+            raise VkontakteError(data['error'])
+        raise gen.Return(data['response'])
+
+
+class AsyncVkontakteApi(VkontakteApiBase):
+    """
+    Asynchronous version of VkontakteApi with the same error handlers and retries.
+    Instance keeps state of the call, so it should be created for each call
+    """
+    api_url = API_URL
+
+    def __init__(self, client):
+        super(AsyncVkontakteApi, self).__init__()
+        self.client = client
+        self.error_class_repeat = self.error_class_repeat + (httpclient.HTTPError,)
+
+    def get_api(self, token):
+        return AsyncApi(token, self.client, self.api_url, self.request_timeout)
+
+    @gen.coroutine
+    def get_api_response(self, *args, **kwargs):
+        self.token_pool.register_call(self.api.token)
+        wait_time = self.rate_limiter.reserve(self.api.token)
+        if wait_time:
+            yield gen.sleep(wait_time)
+        started = time.time()
+        try:
+            response = yield self.api.get(self.method, *args, **kwargs)
+        finally:
+            self.rate_limiter.register_call(wait_time, time.time() - started)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def call(self, method, *args, **kwargs):
+        self.method = method
+        self.set_context()
+
+        try:
+            token = self.get_token()
+        except NoActiveTokens as e:
+            response = yield self.resolve(self.handle_error_no_active_tokens(e, *args, **kwargs))
+            raise gen.Return(response)
+
+        self.api = self.get_api(token)
+
+        # error handlers return futures of repeated calls
+        try:
+            response = yield self.get_api_response(*args, **kwargs)
+        except self.error_class as e:
+            response = self.handle_error_message(e, *args, **kwargs)
+            if response is None:
+                response = self.handle_error_code(e, *args, **kwargs)
+        except self.error_class_repeat as e:
+            response = self.handle_error_repeat(e, *args, **kwargs)
+        except Exception as e:
+            self.log_and_raise(e, *args, **kwargs)
+
+        response = yield self.resolve(response)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def resolve(self, response):
+        if gen.is_future(response):
+            response = yield response
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def sleep_repeat_call(self, *args, **kwargs):
+        yield gen.sleep(kwargs.pop('seconds', 1))
+        response = yield self.repeat_call(*args, **kwargs)
+        raise gen.Return(response)
+
+    def repeat_call(self, *args, **kwargs):
+        self.recursion_count += 1
+        return self.call(self.method, *args, **kwargs)
+
+
+def api_call(method, client=None, **kwargs):
+    """
+    Return future of response of API method. Requests are made by `client` - instance of
+    tornado AsyncHTTPClient, by default shared client of the current IOLoop
+    """
+    return AsyncVkontakteApi(client or httpclient.AsyncHTTPClient()).call(method, **kwargs)
+
+
+@gen.coroutine
+def manager_aget(manager, *args, **kwargs):
+    """
+    Coroutine version of VkontakteManager.get(), parsing of response is executed in a thread
+    """
+    client = kwargs.pop('client', None)
+    extra_fields = kwargs.pop('extra_fields', {})
+    extra_fields['fetched'] = timezone.now()
+    as_records = kwargs.pop('as_records', False)
+
+    method, kwargs = manager.prepare_api_call(*args, **kwargs)
+    response = yield api_call(method, client=client, **kwargs)
+
+    parse_response = partial(close_connections(manager.parse_response), as_records=as_records)
+    result = yield IOLoop.current().run_in_executor(None, parse_response, response, extra_fields)
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def manager_afetch(manager, *args, **kwargs):
+    """
+    Coroutine version of VkontakteManager.fetch(), saving to local DB is executed in a thread.
+    Overridden methods fetch() of managers are not called, arguments should be ready for API call
+    """
+    options = manager.pop_fetch_options(kwargs)
+    result = yield manager_aget(manager, *args, **kwargs)
+
+    save_result = close_connections(atomic(manager.save_result))
+    result = yield IOLoop.current().run_in_executor(None, partial(save_result, result, **options))
+    raise gen.Return(result)
@@ -1,35 +1,323 @@
 # -*- coding: utf-8 -*-
+from abc import ABCMeta
+from collections import deque
+import copy
+from datetime import date
+from hashlib import md5
+import json
+import random
+import threading
+import time
+
 from django.conf import settings
-from social_api.api import ApiAbstractBase, Singleton
+from django.utils import timezone
+from django.utils.six.moves import zip
+from social_api.api import ApiAbstractBase, NoActiveTokens
 from vkontakte import VKError as VkontakteError, API
+from vkontakte.api import _encode, DEFAULT_TIMEOUT
+
+from .cache import get_cache
+from .sessions import get_session
+from .streaming import StreamedResponse
+
+__all__ = ['api_call', 'api_stream', 'batch', 'BatchApiCall', 'ExecuteResponse', 'VkontakteError']
+
+API_URL = getattr(settings, 'VKONTAKTE_API_URL', 'https://api.vk.com/method/')
+
+# TTL of cached responses of read-only methods, for example {'users.get': 300, 'groups.getById': 3600}
+CACHE_METHODS = getattr(settings, 'VKONTAKTE_API_CACHE_METHODS', {})
+# alias of Django cache for sharing responses between processes, by default responses are cached in memory
+CACHE_BACKEND = getattr(settings, 'VKONTAKTE_API_CACHE_BACKEND', None)
+CACHE_MAXSIZE = getattr(settings, 'VKONTAKTE_API_CACHE_MAXSIZE', 10000)
+
+# methods with these prefixes change data and never cached
+WRITE_METHODS_PREFIXES = ('add', 'create', 'delete', 'edit', 'remove', 'restore', 'save', 'send', 'set', 'update',
+                          'post', 'join', 'leave', 'ban', 'unban', 'invite', 'approve', 'hide', 'unhide', 'pin',
+                          'unpin', 'report', 'repost', 'mark', 'accept', 'reorder', 'move', 'copy', 'execute')
+
+response_cache = get_cache(CACHE_BACKEND, maxsize=CACHE_MAXSIZE, prefix='vkontakte_api_response')
+
+
+class ExecuteResponse(list):
+    """
+    Response of method `execute` with list of errors of failed calls, returned as false values in response
+    """
+    def __init__(self, response, execute_errors=None):
+        super(ExecuteResponse, self).__init__(response)
+        self.execute_errors = execute_errors or []
+
+
+class SessionAPI(API):
+    """
+    vkontakte.API, making requests through shared HTTP session with pool of keep-alive connections
+    """
+    url = API_URL
+
+    def _get(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        if method != 'execute':
+            return super(SessionAPI, self)._get(method, timeout=timeout, **kwargs)
+
+        # vkontakte.API returns only value of `response` without `execute_errors`
+        status, content = self._request(method, timeout=timeout, **kwargs)
+        if not (200 <= status <= 299):
+            raise VkontakteError({
+                'error_code': status,
+                'error_msg': "HTTP error",
+                'request_params': kwargs,
+            })
+        data = json.loads(content)
+        if 'error' in data:
+            raise VkontakteError(data['error'])
+        return ExecuteResponse(data['response'], data.get('execute_errors'))
+
+    def post(self, method, timeout=DEFAULT_TIMEOUT, stream=False, **kwargs):
+        params = dict([(key, _encode(value)) for key, value in kwargs.items()])
+        params['access_token'] = self.token
+        params['timestamp'] = int(time.time())
+
+        return get_session().post(self.url + method, data=params, timeout=timeout, stream=stream,
+                                  headers={'Accept': 'application/json'})
+
+    def _request(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        response = self.post(method, timeout=timeout, **kwargs)
+        return response.status_code, response.content
+
+    def stream(self, method, timeout=DEFAULT_TIMEOUT, **kwargs):
+        """
+        Return response, decoded incrementally from body of HTTP response
+        """
+        response = self.post(method, timeout=timeout, stream=True, **kwargs)
+        if not (200 <= response.status_code <= 299):
+            raise VkontakteError({
+                'error_code': response.status_code,
+                'error_msg': "HTTP error",
+                'request_params': kwargs,
+            })
+        response.raw.decode_content = True
+        return StreamedResponse(response.raw, close=response.close)
+
+
+class ThreadLocalSingleton(ABCMeta):
+    """
+    Singleton metaclass with separate instance for each thread, because API instance keeps state of current call
+    """
+    def __init__(cls, name, bases, dictionary):
+        super(ThreadLocalSingleton, cls).__init__(name, bases, dictionary)
+        cls.local = threading.local()
+
+    def __call__(cls, *args, **kwargs):
+        if getattr(cls.local, 'instance', None) is None:
+            cls.local.instance = super(ThreadLocalSingleton, cls).__call__(*args, **kwargs)
+        return cls.local.instance
+
+
+class TokenBucketRateLimiter(object):
+    """
+    Thread-safe limiter of rate of calls with separate token bucket for each key (access token).
+    Collects statistics of time calls were waiting and running
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or rate or 0)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
 
-__all__ = ['api_call', 'VkontakteError']
+    def reset_stats(self):
+        with self.lock:
+            self.calls = 0
+            self.wait_time = 0.
+            self.run_time = 0.
 
+    @property
+    def stats(self):
+        return {'calls': self.calls, 'wait_time': self.wait_time, 'run_time': self.run_time}
 
-class VkontakteApi(ApiAbstractBase):
-    __metaclass__ = Singleton
+    def reserve(self, key):
+        """
+        Reserve a call for the key and return number of seconds to wait before the call
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+            self.buckets[key] = (tokens, now)
+        return -tokens / self.rate if tokens < 0 else 0
+
+    def acquire(self, key):
+        """
+        Wait until call for the key is allowed, return number of seconds of waiting
+        """
+        delay = self.reserve(key)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def penalize(self, key):
+        """
+        Empty bucket of the key after remote server refused call because of the rate
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            tokens, updated = self.buckets.get(key, (0, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            self.buckets[key] = (min(tokens, 0), now)
+
+    def register_call(self, wait_time, run_time):
+        with self.lock:
+            self.calls += 1
+            self.wait_time += wait_time
+            self.run_time += run_time
+
+
+class AccessTokenPool(object):
+    """
+    Thread-safe registry of usage of access tokens: rate of recent calls, number of calls per day
+    and cooldown after errors. Chooses token with the most headroom
+    """
+    window = 10
+
+    def __init__(self, rate, daily_limit=None):
+        self.rate = float(rate or 0)
+        self.daily_limit = daily_limit
+        self.lock = threading.Lock()
+        self.recent_calls = {}
+        self.daily_calls = {}
+        self.cooldowns = {}
+
+    def register_call(self, token):
+        now = time.time()
+        with self.lock:
+            calls = self.recent_calls.setdefault(token, deque())
+            calls.append(now)
+            while calls[0] < now - self.window:
+                calls.popleft()
+
+            day, count = self.daily_calls.get(token, (date.today(), 0))
+            if day != date.today():
+                day, count = date.today(), 0
+            self.daily_calls[token] = (day, count + 1)
+
+    def cooldown(self, token, seconds):
+        with self.lock:
+            self.cooldowns[token] = time.time() + seconds
+
+    def in_cooldown(self, token):
+        return self.cooldowns.get(token, 0) > time.time()
+
+    def release_earliest(self, tokens):
+        """
+        Finish cooldown of the token, which would be available earlier, than others
+        """
+        with self.lock:
+            tokens = [token for token in tokens if token in self.cooldowns]
+            if tokens:
+                del self.cooldowns[min(tokens, key=self.cooldowns.get)]
+                return True
+        return False
+
+    def get_load(self, token):
+        """
+        Return part of used quota of the token: the biggest of recent rate of calls and calls per day
+        """
+        now = time.time()
+        load = 0
+        if self.rate:
+            calls = [call for call in self.recent_calls.get(token, []) if call >= now - self.window]
+            load = len(calls) / (self.rate * self.window)
+        if self.daily_limit:
+            day, count = self.daily_calls.get(token, (None, 0))
+            if day == date.today():
+                load = max(load, float(count) / self.daily_limit)
+        return load
+
+    def choose(self, tokens):
+        """
+        Return token with the most headroom among tokens without cooldown or None
+        """
+        tokens = [token for token in tokens if not self.in_cooldown(token)]
+        if not tokens:
+            return None
+        with self.lock:
+            loads = dict([(token, self.get_load(token)) for token in tokens])
+        load_min = min(loads.values())
+        return random.choice([token for token in tokens if loads[token] == load_min])
+
+
+class VkontakteApiBase(ApiAbstractBase):
 
     provider = 'vkontakte'
     provider_social_auth = 'vk-oauth2'
     error_class = VkontakteError
     request_timeout = getattr(settings, 'VKONTAKTE_API_REQUEST_TIMEOUT', 1)
 
+    # seconds of excluding token from usage after errors
+    token_error_cooldown = getattr(settings, 'VKONTAKTE_API_TOKEN_ERROR_COOLDOWN', 10 * 60)
+    token_flood_control_cooldown = getattr(settings, 'VKONTAKTE_API_TOKEN_FLOOD_CONTROL_COOLDOWN', 60 * 60)
+
+    # shared between instances of all threads
+    rate_limiter = TokenBucketRateLimiter(getattr(settings, 'VKONTAKTE_API_RPS_PER_TOKEN', 3))
+    token_pool = AccessTokenPool(getattr(settings, 'VKONTAKTE_API_RPS_PER_TOKEN', 3),
+                                 getattr(settings, 'VKONTAKTE_API_DAILY_LIMIT_PER_TOKEN', None))
+
     def get_consistent_token(self):
         return getattr(settings, 'VKONTAKTE_API_ACCESS_TOKEN', None)
 
+    def get_token(self):
+        """
+        Return consistent token or token with the most headroom from pool, excluding tokens in cooldown
+        """
+        if self.consistent_token and not self.token_pool.in_cooldown(self.consistent_token):
+            return self.consistent_token
+
+        self.tokens = self.get_tokens()
+
+        if not self.tokens:
+            self.update_tokens()
+            self.tokens = self.get_tokens()
+            if not self.tokens:
+                raise NoActiveTokens("There is no active tokens for provider %s after updating" % self.provider)
+
+        token = self.token_pool.choose(self.tokens)
+        if not token:
+            raise NoActiveTokens("There is no active tokens for provider %s, all tokens are in cooldown" %
+                                 self.provider)
+        return token
+
+    def handle_error_no_active_tokens(self, e, *args, **kwargs):
+        if self.token_pool.release_earliest(self.tokens + [self.consistent_token]):
+            self.logger.warning("Waiting 1 sec, because all active tokens are in cooldown, method: %s, "
+                                "recursion count: %d" % (self.method, self.recursion_count))
+            return self.sleep_repeat_call(*args, **kwargs)
+        return super(VkontakteApiBase, self).handle_error_no_active_tokens(e, *args, **kwargs)
+
     def get_api(self, token):
-        return API(token=token)
+        return SessionAPI(token=token)
 
     def get_api_response(self, *args, **kwargs):
+        self.token_pool.register_call(self.api.token)
+        wait_time = self.rate_limiter.acquire(self.api.token)
+        started = time.time()
+        try:
+            return self.request(*args, **kwargs)
+        finally:
+            self.rate_limiter.register_call(wait_time, time.time() - started)
+
+    def request(self, *args, **kwargs):
         return self.api.get(self.method, timeout=self.request_timeout, *args, **kwargs)
 
     def handle_error_code_5(self, e, *args, **kwargs):
         # code = 5, description = 'User authorization failed: invalid session.'
         # code = 5, description = 'User authorization failed: user revoke access for this token.'
-        self.used_access_tokens += [self.api.token]
+        self.token_pool.cooldown(self.api.token, self.token_error_cooldown)
         return self.repeat_call(*args, **kwargs)
 
     def handle_error_code_6(self, e, *args, **kwargs):
+        self.rate_limiter.penalize(self.api.token)
         self.logger.info("Vkontakte error 'Too many requests per second' on method: %s, recursion count: %d" % (
             self.method, self.recursion_count))
         return self.repeat_call(*args, **kwargs)
@@ -37,7 +325,7 @@ class VkontakteApi(ApiAbstractBase):
     def handle_error_code_9(self, e, *args, **kwargs):
         self.logger.warning("Vkontakte flood control registered while executing method %s with params %s, \
             recursion count: %d" % (self.method, kwargs, self.recursion_count))
-        self.used_access_tokens += [self.api.token]
+        self.token_pool.cooldown(self.api.token, self.token_flood_control_cooldown)
         return self.sleep_repeat_call(*args, **kwargs)
 
     def handle_error_code_10(self, e, *args, **kwargs):
@@ -47,7 +335,7 @@ class VkontakteApi(ApiAbstractBase):
 
     def handle_error_code_17(self, e, *args, **kwargs):
         # code = 17, description = 'Validation required: please open redirect_uri in browser'
-        self.used_access_tokens += [self.api.token]
+        self.token_pool.cooldown(self.api.token, self.token_error_cooldown)
         return self.repeat_call(*args, **kwargs)
         # # TODO: cover with tests
         # from oauth_tokens.models import AccessToken
@@ -88,6 +376,212 @@ class VkontakteApi(ApiAbstractBase):
         return self.sleep_repeat_call(*args, **kwargs)
 
 
-def api_call(*args, **kwargs):
-    api = VkontakteApi()
-    return api.call(*args, **kwargs)
+class VkontakteApi(VkontakteApiBase):
+    __metaclass__ = ThreadLocalSingleton
+
+
+class VkontakteStreamingApi(VkontakteApiBase):
+    """
+    API, returning responses, decoded incrementally from HTTP body
+    """
+    __metaclass__ = ThreadLocalSingleton
+
+    def request(self, *args, **kwargs):
+        return self.api.stream(self.method, timeout=self.request_timeout, *args, **kwargs)
+
+
+def get_cache_ttl(method):
+    name = method.split('.')[-1]
+    if name.startswith(WRITE_METHODS_PREFIXES):
+        return None
+    return CACHE_METHODS.get(method)
+
+
+def get_cache_scope():
+    """
+    Return scope of cached responses: hash of token of the call context, because responses depend on the user of
+    token. Responses for tokens from storages are shared
+    """
+    context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None) or {}
+    token = context.get(VkontakteApiBase.provider, {}).get('token')
+    return md5(token.encode('utf8')).hexdigest() if token else ''
+
+
+def get_cache_key(method, kwargs):
+    params = tuple(sorted([(key, _encode(value)) for key, value in kwargs.items() if key != 'v']))
+    return (method, unicode(kwargs.get('v', '')), params, get_cache_scope())
+
+
+def api_call(method, *args, **kwargs):
+    ttl = get_cache_ttl(method)
+    if not ttl:
+        return VkontakteApi().call(method, *args, **kwargs)
+
+    key = get_cache_key(method, kwargs)
+    response = response_cache.get(key)
+    if response is None:
+        response = VkontakteApi().call(method, *args, **kwargs)
+        response_cache.set(key, response, ttl)
+    # response could be changed during parsing
+    return copy.deepcopy(response)
+
+
+def api_stream(method, *args, **kwargs):
+    """
+    Call API method and return StreamedResponse, iterating resources of response one by one
+    """
+    return VkontakteStreamingApi().call(method, *args, **kwargs)
+
+
+class BatchCall(object):
+    """
+    Single call, collected by BatchApiCall. Keeps result or error of the call after executing the batch
+    """
+    def __init__(self, method, params, callback=None):
+        self.method = method
+        self.params = params
+        self.callback = callback
+        self.executed = False
+        self.response = None
+        self.error = None
+
+    def __repr__(self):
+        return '<BatchCall %s %s>' % (self.method, self.params)
+
+    def set_response(self, response):
+        self.response = self.callback(response) if self.callback else response
+        self.executed = True
+
+    def set_error(self, error):
+        self.error = error
+        self.executed = True
+
+    @property
+    def result(self):
+        if not self.executed:
+            raise ValueError("Batch with call %s is not executed yet" % self)
+        if self.error:
+            raise self.error
+        return self.response
+
+
+class BatchApiCall(object):
+    """
+    Collects API calls and executes them together with method `execute`, up to 25 calls per request.
+    Usage:
+
+        with batch() as b:
+            users = b.get(User.remote, ids=[1, 2])
+            response = b.add('resolveScreenName', screen_name='durov')
+
+        users.result - list of parsed instances
+        response.result - raw response or raised error of the call
+
+    With `stream=True` response of `execute` is decoded incrementally and response of each call is passed
+    to callback before decoding of the next one
+    """
+    limit = 25
+
+    def __init__(self, version=None, stream=False):
+        self.version = version
+        self.stream = stream
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, method, callback=None, **kwargs):
+        """
+        Add call of remote `method` with params. Response of call will be passed to `callback`
+        """
+        call = BatchCall(method, kwargs, callback)
+        self.calls += [call]
+        return call
+
+    def get(self, manager, *args, **kwargs):
+        """
+        Add call of method of manager, response of call will be parsed by `manager.parse_response`
+        """
+        extra_fields = kwargs.pop('extra_fields', {})
+        extra_fields['fetched'] = timezone.now()
+        method, kwargs = manager.prepare_api_call(*args, **kwargs)
+        return self.add(method, lambda response: manager.parse_response(response, extra_fields), **kwargs)
+
+    def get_code(self, calls):
+        """
+        Return VKScript code of `execute` method for list of calls
+        """
+        code = []
+        for call in calls:
+            params = {}
+            for key, value in call.params.items():
+                if isinstance(value, (list, tuple, set)):
+                    value = ','.join([unicode(v) for v in value])
+                params[key] = value
+            code += ['API.%s(%s)' % (call.method, json.dumps(params, sort_keys=True))]
+        return 'return [%s];' % ','.join(code)
+
+    def execute(self):
+        calls = [call for call in self.calls if not call.executed]
+        for i in range(0, len(calls), self.limit):
+            self.execute_calls(calls[i:i + self.limit])
+
+    def execute_calls(self, calls):
+        params = {'code': self.get_code(calls)}
+        version = self.version or max([call.params.get('v', 0) for call in calls])
+        if version:
+            params['v'] = version
+
+        # streamed response of each call is parsed before decoding of the next one
+        response = (api_stream if self.stream else api_call)('execute', **params)
+
+        executed, failed = 0, []
+        resources = iter(response)
+        try:
+            for call, call_response in zip(calls, resources):
+                executed += 1
+                if call_response is False:
+                    # method `execute` returns false instead of response of failed call
+                    failed += [call]
+                else:
+                    call.set_response(call_response)
+            if failed and self.stream:
+                # errors of calls follow the response
+                for call_response in resources:
+                    pass
+        finally:
+            if self.stream:
+                response.close()
+
+        # errors of failed calls are listed in the same order, false is a response of call without error
+        errors = list(getattr(response, 'execute_errors', None) or [])
+        for call in failed:
+            error = ([error for error in errors if error.get('method') == call.method] or [None])[0]
+            if error:
+                errors.remove(error)
+                call.set_error(VkontakteError(dict({'request_params': call.params}, **error)))
+            else:
+                call.set_response(False)
+
+        # response could be shorter than list of calls, for example after error of the code
+        if executed < len(calls):
+            if executed:
+                self.execute_calls(calls[executed:])
+            else:
+                for call in calls:
+                    call.set_error(VkontakteError({
+                        'error_code': 0,
+                        'error_msg': "There is no response of the call in response of method execute",
+                        'request_params': call.params,
+                    }))
+
+
+def batch(*args, **kwargs):
+    return BatchApiCall(*args, **kwargs)
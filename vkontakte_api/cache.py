@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from hashlib import md5
+import threading
+import time
+
+from django.core.cache import caches
+
+__all__ = ['LocalCache', 'DjangoCache', 'get_cache']
+
+
+class CacheStatsMixin(object):
+
+    hits = 0
+    misses = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / requests if requests else 0.,
+            'size': len(self),
+        }
+
+
+class LocalCache(CacheStatsMixin):
+    """
+    Thread-safe in-memory cache with limited number of items, evicting least recently used ones,
+    and with time to live of items
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires and expires < time.time():
+                self.misses += 1
+                return default
+
+            self.items[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + ttl if ttl else None)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class DjangoCache(CacheStatsMixin):
+    """
+    Cache with the same interface, stored by Django cache framework and shared between processes.
+    Size of cache is not available and statistics are collected for the current process
+    """
+    def __init__(self, alias='default', prefix='vkontakte_api', ttl=None):
+        self.alias = alias
+        self.prefix = prefix
+        self.ttl = ttl
+        # version, read by the last get(). Value, set with outdated version, is never returned
+        self.last_version = None
+
+    def __len__(self):
+        return 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def version_key(self):
+        return '%s:version' % self.prefix
+
+    def get_version(self):
+        # version is changed for clearing only own keys of shared cache
+        version = self.cache.get(self.version_key)
+        if version is None:
+            self.cache.add(self.version_key, int(time.time()), None)
+            version = self.cache.get(self.version_key)
+        return version
+
+    def make_key(self, key):
+        return '%s:%s' % (self.prefix, md5(repr(key).encode('utf8')).hexdigest())
+
+    def get(self, key, default=None):
+        # value is stored with version and read together with the current version by one request
+        key = self.make_key(key)
+        values = self.cache.get_many([self.version_key, key])
+        self.last_version = values.get(self.version_key)
+        version, value = values.get(key, (None, None))
+        if version is None or version != self.last_version:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        version = self.last_version or self.get_version()
+        self.cache.set(self.make_key(key), (version, value), self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        try:
+            self.last_version = self.cache.incr(self.version_key)
+        except ValueError:
+            self.last_version = self.get_version()
+
+
+def get_cache(backend=None, **kwargs):
+    """
+    Return local cache or cache, stored by Django cache framework with alias `backend`
+    """
+    if backend:
+        return DjangoCache(backend, **kwargs)
+    kwargs.pop('prefix', None)
+    return LocalCache(**kwargs)
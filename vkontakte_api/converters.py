@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Converters of values of API response to values of model fields, used by VkontakteModel.parse().
+List of converters is defined once for each field of the model
+"""
+from datetime import datetime, date
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.utils import timezone
+
+from . import fields
+from .exceptions import VkontakteParseError
+
+log = logging.getLogger('vkontakte_api')
+
+
+def convert_int(value, instance):
+    return int(value)
+
+
+def convert_integer(value, instance):
+    if value:
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+    return value
+
+
+def convert_positive_integer(value, instance):
+    if value:
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        value = value if value > 0 else 0
+    return value
+
+
+def convert_float(value, instance):
+    if value:
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def convert_char(value, instance):
+    if isinstance(value, bool):
+        return ''
+    try:
+        return unicode(value)
+    except:
+        return value
+
+
+def convert_comma_separated(value, instance):
+    if isinstance(value, list):
+        value = ','.join([unicode(v) for v in value])
+    return value
+
+
+def convert_datetime(value, instance):
+    try:
+        value = int(value)
+        assert value > 0
+        return datetime.utcfromtimestamp(value).replace(tzinfo=timezone.utc)
+    except:
+        return None
+
+
+def convert_date(value, instance):
+    try:
+        # TODO: define tzinfo here
+        return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except:
+        return None
+
+
+def get_one_to_one_converter(field):
+    rel_class = field.rel.to
+
+    def convert_one_to_one(value, instance):
+        if not value:
+            return value
+        if isinstance(value, int):
+            try:
+                return rel_class.objects.get(pk=value)
+            except rel_class.DoesNotExist:
+                raise VkontakteParseError("OneToOne relation of model %s (PK=%s) does not exist" %
+                                          (rel_class.__name__, value))
+        return rel_class().parse(dict(value))
+
+    return convert_one_to_one
+
+
+def get_json_converter(field):
+
+    def convert_json(value, instance):
+        try:
+            field.validate(value, instance)
+        except ValidationError:
+            log.warning("Can not validate json field %s with value %s in the model %s" % (
+                field.name, value, instance.__class__.__name__))
+            value = ''
+        return value
+
+    return convert_json
+
+
+def get_field_converters(field):
+    """
+    Return tuple of converters of value for the field
+    """
+    converters = []
+
+    if isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)):
+        converters += [convert_comma_separated]
+
+    if isinstance(field, models.PositiveIntegerField):
+        converters += [convert_positive_integer]
+    elif isinstance(field, models.IntegerField):
+        converters += [convert_integer]
+    elif isinstance(field, models.FloatField):
+        converters += [convert_float]
+    elif isinstance(field, models.CharField):
+        converters += [convert_char]
+    elif isinstance(field, models.DateTimeField):
+        converters += [convert_datetime]
+    elif isinstance(field, models.DateField):
+        converters += [convert_date]
+
+    if isinstance(field, models.OneToOneField):
+        converters += [get_one_to_one_converter(field)]
+
+    if isinstance(field, fields.JSONField):
+        converters += [get_json_converter(field)]
+
+    return tuple(converters)
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from django.db.models.query import QuerySet
 from django.utils.functional import wraps
 
+from .cache import get_cache
+from .utils import get_pks_lookup, run_prefetched_in_threads
+
 try:
     from django.db.transaction import atomic
 except ImportError:
@@ -26,7 +30,8 @@ def opt_arguments(func):
 
 
 @opt_arguments
-def fetch_all(func, return_all=None, always_all=False, kwargs_offset='offset', kwargs_count='count', default_count=None, max_extra_calls=0):
+def fetch_all(func, return_all=None, always_all=False, kwargs_offset='offset', kwargs_count='count',
+              default_count=None, max_extra_calls=0, concurrency=1):
     """
     Class method decorator for fetching all items. Add parameter `all=False` for decored method.
     If `all` is True, method runs as many times as it returns any results.
@@ -36,45 +41,102 @@ def fetch_all(func, return_all=None, always_all=False, kwargs_offset='offset', k
       * `kwargs_offset` - name of offset parameter among kwargs
       * `always_all` bool - return all instances in any case of argument `all`
         of decorated method
+      * `concurrency` - number of threads for fetching pages in parallel, when the first page
+        has attribute `total_count` with number of all remote items. Pages are fetched by `concurrency` pages
+        until the first not full page. Only the first API call of each page is made in thread, objects are parsed
+        and saved in the calling thread. Can be redefined by argument `concurrency` of decorated method
     Usage:
 
         @fetch_all(return_all=lambda self,instance,*a,**k: instance.items.all())
         def fetch_something(self, ..., *kwargs):
         ....
-    """
 
-    def wrapper(self, all=False, instances_all=None, extra_calls=0, *args, **kwargs):
-        if always_all or all:
+    With argument `as_generator=True` decorated method returns generator of instances, yielded page by page
+    as they are fetched, without keeping fetched pages in memory:
 
-            instances = func(self, *args, **kwargs)
-
-            if isinstance(instances, QuerySet):
-                if instances_all is None:
-                    instances_all = QuerySet().none()
-                instances_all |= instances
-                instances_count = instances.count()
-            elif isinstance(instances, list):
-                if instances_all is None:
-                    instances_all = []
-                instances_all += instances
-                instances_count = len(instances)
-            else:
-                raise ValueError(
-                    "Wrong type of response from func %s. It should be QuerySet or list, not a %s" % (func, type(instances)))
+        for instance in instance.fetch_something(all=True, as_generator=True):
+            ...
+    """
 
-            if instances_count > 0 and (not default_count or instances_count == kwargs.get(kwargs_count, default_count)):
-                # TODO: make protection somehow from endless loop in case
-                # where `kwargs_offset` argument is not make any sense for `func`
+    def get_count(instances):
+        if isinstance(instances, QuerySet):
+            return instances.count()
+        elif isinstance(instances, list):
+            return len(instances)
+        raise ValueError(
+            "Wrong type of response from func %s. It should be QuerySet or list, not a %s" % (func, type(instances)))
+
+    def get_pages(self, concurrency, args, kwargs):
+        """
+        Generator of results of func, called page by page. Updates `kwargs` with offset of the next page
+        """
+        def get_page(offset):
+            return func(self, *args, **dict(kwargs, **{kwargs_offset: offset}))
+
+        extra_calls = 0
+        pages = [func(self, *args, **kwargs)]
+        while pages:
+            instances = pages.pop(0)
+            instances_count = get_count(instances)
+
+            yield instances
+
+            total_count = getattr(instances, 'total_count', None)
+            page_full = not default_count or instances_count == kwargs.get(kwargs_count, default_count)
+
+            # offset of the page can be defined by func, for example after seeking of timeline
+            if getattr(instances, 'offset', None) is not None:
+                kwargs[kwargs_offset] = instances.offset
+
+            if instances_count > 0 and page_full:
                 kwargs[kwargs_offset] = kwargs.get(kwargs_offset, 0) + instances_count
-                return wrapper(self, all=all, instances_all=instances_all, *args, **kwargs)
+                extra_calls = 0
+                if pages:
+                    # the next page is already fetched
+                    continue
+                elif concurrency > 1 and total_count:
+                    # the next `concurrency` pages are fetched in parallel, all offsets are known after the first page.
+                    # Fetched pages after the first not full one are skipped like in sequential fetching
+                    count = kwargs.get(kwargs_count, default_count) or instances_count
+                    offsets = list(range(kwargs[kwargs_offset], total_count, count))[:concurrency]
+                    pages = list(run_prefetched_in_threads(get_page, offsets, concurrency))
+                else:
+                    # TODO: make protection somehow from endless loop in case
+                    # where `kwargs_offset` argument is not make any sense for `func`
+                    pages = [func(self, *args, **kwargs)]
             # попытка решить проблему получения репостов поста https://vk.com/wall-36948301_23383?w=shares%2Fwall-36948301_23383
             elif extra_calls < max_extra_calls - 1:
                 kwargs[kwargs_offset] = kwargs.get(kwargs_offset, 0) + 1
                 extra_calls += 1
-                return wrapper(self, all=all, instances_all=instances_all, extra_calls=extra_calls, *args, **kwargs)
+                pages = [func(self, *args, **kwargs)]
+            else:
+                break
+
+    def wrapper(self, all=False, *args, **kwargs):
+        as_generator = kwargs.pop('as_generator', False)
+        threads = kwargs.pop('concurrency', concurrency)
+
+        if always_all or all:
+
+            if as_generator:
+                return (instance for instances in get_pages(self, threads, args, kwargs) for instance in instances)
+
+            # collect primary keys instead of union of querysets, growing with every page,
+            # only if result is not defined by `return_all`
+            queryset, pks, instances_all = None, set(), []
+            for instances in get_pages(self, threads, args, kwargs):
+                if return_all:
+                    continue
+                elif isinstance(instances, QuerySet):
+                    queryset = instances
+                    pks.update(instances.values_list('pk', flat=True))
+                else:
+                    instances_all += instances
 
             if return_all:
                 return return_all(self, *args, **kwargs)
+            elif queryset is not None:
+                return queryset.model._default_manager.filter(get_pks_lookup(pks))
             else:
                 return instances_all
         else:
@@ -112,15 +174,32 @@ With modifications for properties
 '''
 
 
-def memoize(function):
-    memo = {}
+MEMOIZE_MAXSIZE = getattr(settings, 'VKONTAKTE_API_MEMOIZE_MAXSIZE', 10000)
+MEMOIZE_TTL = getattr(settings, 'VKONTAKTE_API_MEMOIZE_TTL', 60 * 60)
+MEMOIZE_BACKEND = getattr(settings, 'VKONTAKTE_API_MEMOIZE_BACKEND', None)
 
+
+@opt_arguments
+def memoize(function, maxsize=None, ttl=None, backend=None):
+    '''
+    Cache results of function by positional arguments in bounded cache with time to live.
+    Cache is local for process or stored by Django cache framework with alias `backend`.
+    Wrapper has attribute `cache` with statistics and methods `clear()` and `invalidate(*args)`
+    '''
+    cache = get_cache(backend or MEMOIZE_BACKEND, maxsize=maxsize or MEMOIZE_MAXSIZE,
+                      ttl=MEMOIZE_TTL if ttl is None else ttl,
+                      prefix='vkontakte_api_memoize:%s.%s' % (function.__module__, function.__name__))
+    missed = object()
+
+    @wraps(function)
     def wrapper(*args, **kwargs):
-        key = args
-        if key in memo:
-            return memo[key]
-        else:
-            result = function(*args, **kwargs) if hasattr(function, '__call__') else function
-            memo[key] = result
-            return result
+        result = cache.get(args, missed)
+        if result is missed:
+            result = function(*args, **kwargs)
+            cache.set(args, result)
+        return result
+
+    wrapper.cache = cache
+    wrapper.clear = cache.clear
+    wrapper.invalidate = lambda *args: cache.delete(args)
     return wrapper
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from vkontakte_api.scheduler import RefreshScheduler
+
+
+class Command(BaseCommand):
+    help = 'Refresh stale objects of models from the most overdue and popular within budget of API calls per minute'
+
+    # Django 1.7 doesn't support add_arguments()
+    if django.VERSION < (1, 8):
+        args = '<app_label.ModelName app_label.ModelName ...>'
+        option_list = BaseCommand.option_list + (
+            make_option('--expires', type='int', help='Seconds after fetching, when object should be refreshed'),
+            make_option('--budget', type='int', help='API calls per minute for each model'),
+            make_option('--chunk', type='int', help='Number of objects, refreshed by one call'),
+            make_option('--calls', type='int',
+                        help='Number of calls for each model, by default number of calls per minute'),
+            make_option('--forever', action='store_true', default=False, help='Refresh stale objects constantly'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='+', help='Models in format app_label.ModelName')
+        parser.add_argument('--expires', type=int, help='Seconds after fetching, when object should be refreshed')
+        parser.add_argument('--budget', type=int, help='API calls per minute for each model')
+        parser.add_argument('--chunk', type=int, help='Number of objects, refreshed by one call')
+        parser.add_argument('--calls', type=int,
+                            help='Number of calls for each model, by default number of calls per minute')
+        parser.add_argument('--forever', action='store_true', help='Refresh stale objects constantly')
+
+    def handle(self, *args, **options):
+        labels = options.get('models') or args
+        if not labels:
+            raise CommandError('At least one model should be specified')
+
+        schedulers = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+            schedulers += [RefreshScheduler(model, expires=options.get('expires'), budget=options.get('budget'),
+                                            chunk=options.get('chunk'))]
+
+        while True:
+            refreshed = 0
+            for scheduler in schedulers:
+                count = scheduler.run(options.get('calls'))
+                self.stdout.write('Refreshed %d stale objects of %s' % (count, scheduler.model._meta.object_name))
+                refreshed += count
+            if not options.get('forever'):
+                break
+            elif not refreshed:
+                # nothing to refresh yet
+                time.sleep(60)
@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
 import logging
 
+from django.conf import settings
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, IntegrityError
 from m2m_history.fields import ManyToManyHistoryField
 from vkontakte_users.models import User
 
 from .decorators import memoize, atomic
 from . import fields
 from .models import VkontakteManager, VkontakteTimelineManager
+from .utils import diff_sorted_ids
 
 
 log = logging.getLogger('vkontakte_api')
 
+# fetch profiles of new owners and authors before parsing of response
+FETCH_OWNERS = getattr(settings, 'VKONTAKTE_API_FETCH_OWNERS', False)
+
 
 @memoize
 def get_or_create_group_or_user(remote_id):
@@ -30,6 +35,48 @@ def get_or_create_group_or_user(remote_id):
     return Model.objects.get_or_create(remote_id=abs(remote_id))[0]
 
 
+def get_or_create_groups_and_users(remote_ids, fetch=False):
+    """
+    Get or create users by positive and groups by negative remote ids with bulk queries and remember them
+    for get_or_create_group_or_user(). Profiles of new users and groups are fetched from API if `fetch` is True
+    """
+    from vkontakte_groups.models import Group
+
+    missed = object()
+    remote_ids = set([remote_id for remote_id in remote_ids
+                      if remote_id and get_or_create_group_or_user.cache.get((remote_id,), missed) is missed])
+
+    for Model, sign in [(User, 1), (Group, -1)]:
+        ids = [remote_id * sign for remote_id in remote_ids if remote_id * sign > 0]
+        if not ids:
+            continue
+
+        instances = dict([(instance.remote_id, instance) for instance in Model.objects.filter(remote_id__in=ids)])
+        ids_new = set(ids) - set(instances)
+        if ids_new:
+            if fetch:
+                Model.remote.fetch(ids=list(ids_new))
+            else:
+                try:
+                    with atomic():
+                        Model.objects.bulk_create([Model(remote_id=remote_id) for remote_id in ids_new])
+                except IntegrityError:
+                    # created by another process, will be got by get_or_create_group_or_user()
+                    pass
+            instances.update([(instance.remote_id, instance)
+                              for instance in Model.objects.filter(remote_id__in=ids_new)])
+
+        for remote_id, instance in instances.items():
+            get_or_create_group_or_user.cache.set((remote_id * sign,), instance)
+
+
+def prepare_groups_and_users(model, resources):
+    # authors and owners are collected together by the first mixin in MRO, the second one finds them in cache
+    keys = [key for key, mixin in [('from_id', AuthorableModelMixin), ('owner_id', OwnerableModelMixin)]
+            if issubclass(model, mixin)]
+    get_or_create_groups_and_users([resource.get(key) for resource in resources for key in keys], fetch=FETCH_OWNERS)
+
+
 class CountOffsetManagerMixin(VkontakteManager):
 
     def fetch(self, count=100, offset=0, **kwargs):
@@ -74,11 +121,19 @@ class ActionableModelMixin(models.Model):
     class Meta:
         abstract = True
 
-    def save(self, *args, **kwargs):
+    def set_actions_count(self):
         self.actions_count = sum([getattr(self, field, None) or 0
                                   for field in ['likes_count', 'reposts_count', 'comments_count']])
+
+    def save(self, *args, **kwargs):
+        self.set_actions_count()
         super(ActionableModelMixin, self).save(*args, **kwargs)
 
+    def parse(self, response):
+        super(ActionableModelMixin, self).parse(response)
+        # bulk fetching saves instances without calling save()
+        self.set_actions_count()
+
 
 class AuthorableModelMixin(models.Model):
 
@@ -98,6 +153,11 @@ class AuthorableModelMixin(models.Model):
     def by_user(self):
         return self.author_content_type.model == 'user' and self.author_content_type.app_label == 'vkontakte_users'
 
+    @classmethod
+    def prepare_resources(cls, resources):
+        prepare_groups_and_users(cls, resources)
+        super(AuthorableModelMixin, cls).prepare_resources(resources)
+
     def parse(self, response):
         if 'from_id' in response:
             self.author = get_or_create_group_or_user(response.pop('from_id'))
@@ -140,6 +200,11 @@ class OwnerableModelMixin(models.Model):
         else:
             raise ValueError("Field owner should store User of Group, not %s" % owner.__class__)
 
+    @classmethod
+    def prepare_resources(cls, resources):
+        prepare_groups_and_users(cls, resources)
+        super(OwnerableModelMixin, cls).prepare_resources(resources)
+
     def parse(self, response):
         if 'owner_id' in response:
             self.owner = get_or_create_group_or_user(response.pop('owner_id'))
@@ -151,6 +216,9 @@ class LikableModelMixin(models.Model):
     likes_users = ManyToManyHistoryField(User, related_name='like_%(class)ss')
     likes_count = models.PositiveIntegerField(u'Likes', null=True, db_index=True)
 
+    # name of field for value of likes_count while the last fetching of likes, required for incremental fetching
+    likes_synced_count_field = None
+
     class Meta:
         abstract = True
 
@@ -160,6 +228,15 @@ class LikableModelMixin(models.Model):
 
     @atomic
     def fetch_likes(self, *args, **kwargs):
+        """
+        Fetch users, who liked the object. With argument `incremental=True` and defined `likes_synced_count_field`
+        only added and removed likes are saved and fetching is skipped, if `likes_count` is not changed since
+        the last fetching of likes
+        """
+        synced_field = self.likes_synced_count_field
+        incremental = kwargs.pop('incremental', False) and synced_field is not None
+        if incremental and self.likes_count is not None and self.likes_count == getattr(self, synced_field):
+            return self.likes_users.all()
 
         kwargs['likes_type'] = self.likes_remote_type
         kwargs['item_id'] = self.remote_id_short
@@ -168,17 +245,32 @@ class LikableModelMixin(models.Model):
         log.debug('Fetching likes of %s %s of owner "%s"' % (self._meta.module_name, self.remote_id, self.owner))
 
         ids = User.remote.fetch_likes_user_ids(*args, **kwargs)
-        self.likes_users = User.remote.fetch(ids=ids, only_expired=True)
+        if incremental:
+            added, removed = diff_sorted_ids(self.likes_users.values_list('pk', flat=True), ids)
+            if added:
+                User.remote.fetch_ids(list(added))
+                self.likes_users.add(*added)
+            if removed:
+                self.likes_users.remove(*removed)
+            likes_count = len(set(ids))
+        else:
+            self.likes_users = User.remote.fetch_ids(ids)
+            likes_count = self.likes_users.count()
 
         # update self.likes_count
-        likes_count = self.likes_users.count()
         if likes_count < self.likes_count:
             log.warning('Fetched ammount of like users less, than attribute `likes` of post "%s": %d < %d' % (
                 self.remote_id, likes_count, self.likes_count))
         elif likes_count > self.likes_count:
             self.likes_count = likes_count
+            if synced_field:
+                setattr(self, synced_field, likes_count)
             self.save()
 
+        if synced_field and getattr(self, synced_field) != self.likes_count:
+            setattr(self, synced_field, self.likes_count)
+            self.__class__.objects.filter(pk=self.pk).update(**{synced_field: self.likes_count})
+
         return self.likes_users.all()
 
     def parse(self, response):
@@ -201,3 +293,16 @@ class RawModelMixin(models.Model):
     def parse(self, response):
         self.raw_json = dict(response)
         super(RawModelMixin, self).parse(response)
+
+
+class ContentHashModelMixin(models.Model):
+    """
+    Keep hash of API resource. Objects with unchanged resource are not saved again while fetching,
+    only field `fetched` is updated
+    """
+    content_hash_field = 'content_hash'
+
+    content_hash = models.CharField(max_length=32, null=True, editable=False)
+
+    class Meta:
+        abstract = True
@@ -1,28 +1,99 @@
 # -*- coding: utf-8 -*-
 import sys
 from abc import abstractmethod
-from datetime import datetime, date
+from collections import OrderedDict
+import copy
+from datetime import datetime, timedelta
+from hashlib import md5
+import json
 import logging
 import re
 
 from django.conf import settings
-from django.db import models, IntegrityError
-from django.core.exceptions import ValidationError
+from django.db import models, router, IntegrityError
+from django.db.models import signals
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.db.models.query_utils import DeferredAttribute
 from django.utils import timezone, six
 
-from . import fields
-from .api import api_call, VkontakteError
+from .api import api_call, api_stream, batch, VkontakteError
+from .cache import LocalCache
+from .converters import convert_int, get_field_converters
 from .exceptions import VkontakteContentError, VkontakteParseError, WrongResponseType
-from .signals import vkontakte_api_post_fetch
+from .signals import vkontakte_api_post_fetch, vkontakte_api_post_fetch_batch
 from .decorators import atomic
+from .upsert import get_update_fields, is_upsert_supported, upsert
+from .utils import prefetched_call, run_prefetched_in_threads
 
 
 log = logging.getLogger('vkontakte_api')
 
 COMMIT_REMOTE = getattr(settings, 'VKONTAKTE_API_COMMIT_REMOTE', True)
 MASTER_DATABASE = getattr(settings, 'VKONTAKTE_API_MASTER_DATABASE', 'default')
+# insert or update rows by remote_id with one statement, if database supports it
+NATIVE_UPSERT = getattr(settings, 'VKONTAKTE_API_NATIVE_UPSERT', False)
+# number of threads and seconds of expiration of objects for VkontakteManager.fetch_ids()
+FETCH_IDS_CONCURRENCY = getattr(settings, 'VKONTAKTE_API_FETCH_IDS_CONCURRENCY', 1)
+FETCH_IDS_EXPIRES = getattr(settings, 'VKONTAKTE_API_FETCH_IDS_EXPIRES', 24 * 60 * 60)
+# send signal vkontakte_api_post_fetch for each saved instance, signal vkontakte_api_post_fetch_batch is sent anyway
+POST_FETCH_SIGNAL = getattr(settings, 'VKONTAKTE_API_POST_FETCH_SIGNAL', True)
+
+# remote ids of resolved screen names
+slugs_cache = LocalCache(maxsize=getattr(settings, 'VKONTAKTE_API_SLUGS_CACHE_MAXSIZE', 10000),
+                         ttl=getattr(settings, 'VKONTAKTE_API_SLUGS_CACHE_TTL', 24 * 60 * 60))
+
+
+class VkontakteResponseList(list):
+    """
+    List of parsed instances with total number of remote items, returned in response by API
+    """
+    def __init__(self, instances, total_count=None):
+        super(VkontakteResponseList, self).__init__(instances)
+        self.total_count = total_count
+
+
+class VkontakteResponseStream(object):
+    """
+    Iterator of parsed instances of streamed response, instances are parsed one by one while reading response
+    """
+    def __init__(self, manager, response, extra_fields=None):
+        self.manager = manager
+        self.response = response
+        self.extra_fields = extra_fields
+
+    def __iter__(self):
+        try:
+            for resource in self.response:
+                resource = self.manager.get_response_resource(resource)
+                if resource is not None:
+                    yield self.manager.parse_response_dict(resource, self.extra_fields)
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
+
+    @property
+    def total_count(self):
+        return self.response.total_count
+
+
+class VkontakteRecord(object):
+    """
+    Lightweight record with values of fields of model, parsed from API response without instantiating of model.
+    Classes of records are created for each model by VkontakteModel.get_record_class()
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__,
+                             ', '.join(['%s=%r' % (name, getattr(self, name)) for name in self.__slots__]))
 
 
 class VkontakteManager(models.Manager):
@@ -33,8 +104,15 @@ class VkontakteManager(models.Manager):
     methods = {}
     remote_pk = ()
     version = None
-
-    def __init__(self, methods_namespace=None, methods=None, remote_pk=None, version=None, *args, **kwargs):
+    bulk = False
+    # arguments of fetch() for saving objects, not for API call
+    fetch_options = ('bulk',)
+    # argument of fetch() for list of remote ids and maximum length of it for method fetch_ids()
+    ids_argument = 'ids'
+    ids_chunk = 1000
+
+    def __init__(self, methods_namespace=None, methods=None, remote_pk=None, version=None, bulk=None, *args,
+                 **kwargs):
         if methods and len(methods.items()) < 1:
             raise ValueError('Argument methods must contains at least 1 specified method')
 
@@ -50,43 +128,77 @@ class VkontakteManager(models.Manager):
         if version:
             self.version = version
 
+        if bulk is not None:
+            self.bulk = bulk
+
         super(VkontakteManager, self).__init__(*args, **kwargs)
 
+    def get_slug_by_url(self, url):
+        m = re.findall(r'^(?:https?://)?(?:new\.)?vk.com/([^/\?]+)', url)
+        if not len(m):
+            raise ValueError("Url should be started with http://vk.com/")
+        return m[0]
+
+    def get_remote_id_by_slug_prefix(self, slug):
+        """
+        Return remote_id from slug like id123, club123 or None
+        """
+        if self.model.slug_prefix and slug.startswith(self.model.slug_prefix):
+            m = re.findall(r'^%s(\d+)$' % self.model.slug_prefix, slug)
+            if m:
+                return int(m[0])
+        return None
+
+    def get_remote_id_from_resolved(self, slug, response):
+        """
+        Return remote_id from response of method resolveScreenName
+        """
+        if not response:
+            log.error("Method resolveScreenName returned empty response. Slug: '%s'" % slug)
+            return None
+
+        if response['type'] not in self.model.resolve_screen_name_types:
+            raise WrongResponseType("Method get_by_slug returned instance with wrong type '%s', not '%s'. Slug is '%s'" % (
+                response['type'], self.model.resolve_screen_name_types, slug))
+
+        try:
+            return int(response['object_id'])
+        except (KeyError, TypeError, ValueError) as e:
+            # TODO: raise error
+            log.error("Method get_by_slug returned response in strange format: %s. Slug is '%s'" %
+                      (response, slug))
+            return None
+
     def get_by_url(self, url):
         """
         Return vkonakte object by url
         """
-        m = re.findall(r'^(?:https?://)?(?:new\.)?vk.com/([^/\?]+)', url)
-        if not len(m):
-            raise ValueError("Url should be started with http://vk.com/")
+        return self.get_by_slug(self.get_slug_by_url(url))
 
-        return self.get_by_slug(m[0])
+    def get_by_urls(self, urls):
+        """
+        Return dict of vkontakte objects by urls
+        """
+        slugs = OrderedDict([(url, self.get_slug_by_url(url)) for url in urls])
+        objects = self.get_by_slugs(slugs.values())
+        return OrderedDict([(url, objects[slug]) for url, slug in slugs.items()])
 
     def get_by_slug(self, slug):
         """
         Return existed User, Group, Application by slug or new intance with empty pk
         """
-        try:
-            assert self.model.slug_prefix and slug.startswith(self.model.slug_prefix)
-            remote_id = int(re.findall(r'^%s(\d+)$' % self.model.slug_prefix, slug)[0])
-        except (AssertionError, ValueError, IndexError):
+        remote_id = self.get_remote_id_by_slug_prefix(slug) or slugs_cache.get((self.model, slug))
+        if remote_id is None:
             try:
                 response = api_call('resolveScreenName', **{'screen_name': slug})
             except VkontakteError as e:
                 log.error("Method get_by_slug returned error instead of response. Slug: '%s'. Error: %s" % (slug, e))
                 return None
 
-            if response['type'] not in self.model.resolve_screen_name_types:
-                raise WrongResponseType("Method get_by_slug returned instance with wrong type '%s', not '%s'. Slug is '%s'" % (
-                    response['type'], self.model.resolve_screen_name_types, slug))
-
-            try:
-                remote_id = int(response['object_id'])
-            except (KeyError, TypeError, ValueError) as e:
-                # TODO: raise error
-                log.error("Method get_by_slug returned response in strange format: %s. Slug is '%s'" %
-                          (response, slug))
+            remote_id = self.get_remote_id_from_resolved(slug, response)
+            if remote_id is None:
                 return None
+            slugs_cache.set((self.model, slug), remote_id)
 
         try:
             object = self.model.objects.get(remote_id=remote_id)
@@ -96,6 +208,54 @@ class VkontakteManager(models.Manager):
 
         return object
 
+    def get_by_slugs(self, slugs):
+        """
+        Return dict of existed or new instances by slugs, None for not resolved slugs.
+        Known screen names are found by one query, others are resolved by batches of API calls
+        """
+        remote_ids = OrderedDict()
+        unknown = []
+        for slug in slugs:
+            remote_ids[slug] = self.get_remote_id_by_slug_prefix(slug) or slugs_cache.get((self.model, slug))
+            if remote_ids[slug] is None:
+                unknown += [slug]
+
+        objects = {}
+        if unknown and 'screen_name' in [field.name for field in self.model._meta.fields]:
+            for object in self.model.objects.filter(screen_name__in=unknown):
+                objects[object.remote_id] = object
+                remote_ids[object.screen_name] = object.remote_id
+                slugs_cache.set((self.model, object.screen_name), object.remote_id)
+            unknown = [slug for slug in unknown if remote_ids[slug] is None]
+
+        if unknown:
+            with batch() as b:
+                calls = [(slug, b.add('resolveScreenName', screen_name=slug)) for slug in unknown]
+            for slug, call in calls:
+                try:
+                    remote_ids[slug] = self.get_remote_id_from_resolved(slug, call.result)
+                except VkontakteError as e:
+                    log.error("Method get_by_slugs returned error instead of response. Slug: '%s'. Error: %s" % (
+                        slug, e))
+                if remote_ids[slug] is not None:
+                    slugs_cache.set((self.model, slug), remote_ids[slug])
+
+        missed = set([remote_id for remote_id in remote_ids.values() if remote_id is not None]) - set(objects)
+        if missed:
+            for object in self.model.objects.filter(remote_id__in=missed):
+                objects[object.remote_id] = object
+
+        result = OrderedDict()
+        for slug, remote_id in remote_ids.items():
+            if remote_id is None:
+                result[slug] = None
+            elif remote_id in objects:
+                result[slug] = objects[remote_id]
+                result[slug].screen_name = slug
+            else:
+                result[slug] = self.model(remote_id=remote_id, screen_name=slug)
+        return result
+
     def get_or_create_from_instance(self, instance):
 
         old_instance = None
@@ -107,6 +267,10 @@ class VkontakteManager(models.Manager):
             try:
                 old_instance = self.model.objects.using(MASTER_DATABASE).get(**remote_pk_dict)
                 instance._substitute(old_instance)
+                if instance.is_content_unchanged(old_instance):
+                    # only time of fetching of unchanged object is updated
+                    self.touch_fetched([instance])
+                    return instance
                 instance.save()
             except self.model.DoesNotExist:
                 instance.save()
@@ -115,17 +279,139 @@ class VkontakteManager(models.Manager):
             instance.save()
             log.debug('Fetch and create new object %s without remote pk' % (self.model,))
 
-        vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=(not old_instance))
+        # for splitting of created and updated instances in signal vkontakte_api_post_fetch_batch
+        instance._fetch_created = not old_instance
+        if POST_FETCH_SIGNAL:
+            vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=(not old_instance))
         return instance
 
+    def touch_fetched(self, instances):
+        """
+        Mark instances of unchanged objects as saved and update only time of fetching of them
+        """
+        pks_by_fetched = {}
+        for instance in instances:
+            instance._fetch_created = False
+            instance._fetch_unchanged = True
+            instance._state.adding = False
+            instance._state.db = MASTER_DATABASE
+            pks_by_fetched.setdefault(instance.fetched, []).append(instance.pk)
+
+        for fetched, pks in pks_by_fetched.items():
+            self.model._base_manager.using(MASTER_DATABASE).filter(pk__in=pks).update(fetched=fetched)
+
+    def send_post_fetch_batch(self, instances, saved):
+        """
+        Send signal vkontakte_api_post_fetch_batch for instances, saved by get_or_create_from_instance()
+        """
+        created = [instance for instance in saved if getattr(instance, '_fetch_created', False)]
+        updated = [instance for instance in saved if not getattr(instance, '_fetch_created', False)
+                   and not getattr(instance, '_fetch_unchanged', False)]
+        vkontakte_api_post_fetch_batch.send(sender=self.model, instances=instances, created=created, updated=updated)
+
+    def get_remote_pk_lookup(self, instances):
+        """
+        Return Q object for selecting objects with the same remote pk as instances
+        """
+        if len(self.remote_pk) == 1:
+            field_name = self.remote_pk[0]
+            return Q(**{'%s__in' % field_name: [getattr(instance, field_name) for instance in instances]})
+
+        lookup = Q(pk__in=[])
+        for instance in instances:
+            lookup |= Q(**dict([(field_name, getattr(instance, field_name)) for field_name in self.remote_pk]))
+        return lookup
+
+    def get_or_create_from_instances(self, instances):
+        """
+        Bulk version of get_or_create_from_instance() for list of instances with the same effect:
+        existed objects are selected by `remote_pk` with one query, new objects are inserted with one query,
+        existed objects are updated without preliminary selecting.
+        Methods save() of instances are not called.
+        Return queryset of saved objects
+        """
+        if not self.remote_pk:
+            return self.model.objects.filter(pk__in={self.get_or_create_from_instance(instance).pk
+                                                     for instance in instances})
+
+        def get_remote_pk(instance):
+            return tuple([getattr(instance, field_name) for field_name in self.remote_pk])
+
+        # the last one of instances with the same remote pk wins
+        instances = OrderedDict([(get_remote_pk(instance), instance) for instance in instances]).values()
+        lookup = self.get_remote_pk_lookup(instances)
+
+        old_instances = dict([(get_remote_pk(old_instance), old_instance)
+                              for old_instance in self.model.objects.using(MASTER_DATABASE).filter(lookup)])
+
+        created, updated, unchanged = [], [], []
+        for instance in instances:
+            old_instance = old_instances.get(get_remote_pk(instance))
+            if old_instance:
+                instance._substitute(old_instance)
+                if instance.is_content_unchanged(old_instance):
+                    unchanged += [instance]
+                else:
+                    updated += [instance]
+            else:
+                created += [instance]
+
+        if unchanged:
+            self.touch_fetched(unchanged)
+
+        if created:
+            self.model.objects.using(MASTER_DATABASE).bulk_create(created)
+            log.debug('Fetch and create %d new objects %s' % (len(created), self.model))
+
+            # bulk_create() doesn't define primary keys of instances on most of databases and versions of Django
+            if [instance for instance in created if instance.pk is None]:
+                queryset = self.model.objects.using(MASTER_DATABASE).filter(self.get_remote_pk_lookup(created))
+                pks = dict([(values[:-1], values[-1])
+                            for values in queryset.values_list(*(list(self.remote_pk) + ['pk']))])
+                for instance in created:
+                    instance.pk = pks.get(get_remote_pk(instance))
+            for instance in created:
+                instance._state.adding = False
+                instance._state.db = MASTER_DATABASE
+
+        if updated and NATIVE_UPSERT and self.remote_pk == ('remote_id',) \
+                and is_upsert_supported(self.model, MASTER_DATABASE):
+            upsert(self.model, updated, MASTER_DATABASE)
+        else:
+            fields_update = get_update_fields(self.model)
+            for instance in updated:
+                values = dict([(field.attname, field.pre_save(instance, False)) for field in fields_update])
+                self.model._base_manager.using(MASTER_DATABASE).filter(pk=instance.pk).update(**values)
+
+        instances = self.model.objects.filter(lookup)
+        vkontakte_api_post_fetch_batch.send(sender=self.model, instances=instances, created=created, updated=updated)
+        return instances
+
     def get_or_create_from_resource(self, resource):
 
         instance = self.model()
-        instance.parse(dict(resource))
+        self.parse_resource(instance, dict(resource))
 
         return self.get_or_create_from_instance(instance)
 
-    def api_call(self, method='get', methods_namespace=None, **kwargs):
+    def parse_resource(self, instance, resource):
+        """
+        Parse resource to instance. Hash of content is calculated from untouched resource,
+        because parse methods of mixins pop values from it
+        """
+        if instance.content_hash_field:
+            setattr(instance, instance.content_hash_field, instance.get_content_hash(resource))
+        instance.parse(resource)
+
+    def api_call(self, *args, **kwargs):
+        method, kwargs = self.prepare_api_call(*args, **kwargs)
+        response = prefetched_call(lambda: api_call(method, **kwargs))
+        return response
+
+    def prepare_api_call(self, method='get', methods_namespace=None, **kwargs):
+        """
+        Return full name of remote method and parameters of call, defined by name of method of manager
+        """
         if self.model.methods_access_tag:
             kwargs['methods_access_tag'] = self.model.methods_access_tag
 
@@ -157,22 +443,98 @@ class VkontakteManager(models.Manager):
         if methods_namespace:
             method = methods_namespace + '.' + method
 
-        response = api_call(method, **kwargs)
-        return response
+        return method, kwargs
 
     @atomic
     def fetch(self, *args, **kwargs):
         """
-        Retrieve and save object to local DB
+        Retrieve and save object to local DB.
+        Arguments from `fetch_options` are passed to save_result()
         """
+        options = self.pop_fetch_options(kwargs)
         result = self.get(*args, **kwargs)
-        if isinstance(result, list):
-            return self.model.objects.filter(
-                    pk__in={self.get_or_create_from_instance(instance).pk for instance in result})
+        return self.save_result(result, **options)
+
+    def fetch_ids(self, ids, chunk=None, concurrency=None, expires=None, argument=None, **kwargs):
+        """
+        Fetch objects by list of remote ids of any length. Objects, fetched less than `expires` seconds ago,
+        are selected with one query and skipped. Others are fetched by chunks of `chunk` ids,
+        passed to fetch() in argument `argument`, with API calls in `concurrency` threads.
+        Objects are saved in the calling thread. Return queryset of all objects with remote ids
+        """
+        chunk = chunk or self.ids_chunk
+        concurrency = concurrency or FETCH_IDS_CONCURRENCY
+        expires = FETCH_IDS_EXPIRES if expires is None else expires
+        argument = argument or self.ids_argument
+
+        ids = list(OrderedDict.fromkeys(ids))
+        if expires:
+            fetched = set(self.model.objects.filter(remote_id__in=ids, fetched__gte=timezone.now() - timedelta(
+                seconds=expires)).values_list('remote_id', flat=True))
+            ids_expired = [remote_id for remote_id in ids if remote_id not in fetched]
+        else:
+            ids_expired = ids
+
+        def fetch_chunk(ids_chunk):
+            self.fetch(**dict(kwargs, **{argument: ids_chunk}))
+
+        chunks = [ids_expired[i:i + chunk] for i in range(0, len(ids_expired), chunk)]
+        if concurrency > 1 and len(chunks) > 1:
+            list(run_prefetched_in_threads(fetch_chunk, chunks, concurrency))
+        else:
+            for ids_chunk in chunks:
+                fetch_chunk(ids_chunk)
+
+        return self.model.objects.filter(remote_id__in=ids)
+
+    def pop_fetch_options(self, kwargs):
+        """
+        Extract arguments of saving fetched objects from arguments of API call
+        """
+        return dict([(key, kwargs.pop(key)) for key in self.fetch_options if key in kwargs])
+
+    def save_result(self, result, bulk=None):
+        """
+        Save result of method get() to local DB.
+        With argument `bulk` list of objects is saved by get_or_create_from_instances()
+        """
+        bulk = self.bulk if bulk is None else bulk
+        if isinstance(result, (list, VkontakteResponseStream)):
+            if bulk:
+                instances = self.get_or_create_from_instances(result)
+            else:
+                # saved instances are kept only for receivers of the signal
+                listened = vkontakte_api_post_fetch_batch.has_listeners(self.model)
+                pks, saved = set(), []
+                for instance in result:
+                    instance = self.get_or_create_from_instance(instance)
+                    pks.add(instance.pk)
+                    if listened:
+                        saved += [instance]
+                instances = self.model.objects.filter(pk__in=pks)
+                self.send_post_fetch_batch(instances, saved)
+            instances.total_count = getattr(result, 'total_count', None)
+            return instances
         elif isinstance(result, QuerySet):
             return result
         else:
-            return self.get_or_create_from_instance(result)
+            instance = self.get_or_create_from_instance(result)
+            self.send_post_fetch_batch([instance], [instance])
+            return instance
+
+    def aget(self, *args, **kwargs):
+        """
+        Coroutine of retrieving objects from remote server by asynchronous client
+        """
+        from .aio import manager_aget
+        return manager_aget(self, *args, **kwargs)
+
+    def afetch(self, *args, **kwargs):
+        """
+        Coroutine of retrieving objects by asynchronous client and saving them to local DB in a thread
+        """
+        from .aio import manager_afetch
+        return manager_afetch(self, *args, **kwargs)
 
     def get(self, *args, **kwargs):
         """
@@ -181,19 +543,32 @@ class VkontakteManager(models.Manager):
         """
         extra_fields = kwargs.pop('extra_fields', {})
         extra_fields['fetched'] = timezone.now()
+        as_records = kwargs.pop('as_records', False)
+
+        if kwargs.pop('stream', False):
+            method, kwargs = self.prepare_api_call(*args, **kwargs)
+            return VkontakteResponseStream(self, prefetched_call(lambda: api_stream(method, **kwargs)), extra_fields)
 
         response = self.api_call(*args, **kwargs)
 
-        return self.parse_response(response, extra_fields)
+        return self.parse_response(response, extra_fields, as_records=as_records)
 
-    def parse_response(self, response, extra_fields=None):
+    def parse_response(self, response, extra_fields=None, as_records=False):
+        """
+        Parse response to instances of model or to lightweight records if `as_records` is True
+        """
 
+        total_count = None
         if self.version >= 4.93 and isinstance(response, dict) and 'items' in response:
+            total_count = response.get('count')
             response = response['items']
 
         if isinstance(response, (list, tuple)):
-            return self.parse_response_list(response, extra_fields)
+            parse_response_list = self.parse_response_records if as_records else self.parse_response_list
+            return VkontakteResponseList(parse_response_list(response, extra_fields), total_count)
         elif isinstance(response, dict):
+            if as_records:
+                return self.model.parse_record(response, extra_fields)
             return self.parse_response_dict(response, extra_fields)
         else:
             raise VkontakteContentError('Vkontakte response should be list or dict, not %s' % response)
@@ -205,64 +580,152 @@ class VkontakteManager(models.Manager):
         if extra_fields:
             for k, v in extra_fields.items():
                 setattr(instance, k, v)
-        instance.parse(resource)
+        self.parse_resource(instance, resource)
 
         return instance
 
-    def parse_response_list(self, response_list, extra_fields=None):
+    def get_response_resource(self, resource):
+        """
+        Return dictionary of resource from element of response list or None for skipping it
+        """
+        # in response with stats there is extra array inside each element
+        if isinstance(resource, list) and len(resource):
+            resource = resource[0]
 
-        instances = []
-        for resource in response_list:
+        # in some responses first value is `count` of all values:
+        # http://vk.com/developers.php?oid=-1&p=groups.search
+        if isinstance(resource, int):
+            return None
 
-            # in response with stats there is extra array inside each element
-            if isinstance(resource, list) and len(resource):
-                resource = resource[0]
+        try:
+            return dict(resource)
+        except (TypeError, ValueError) as e:
+            log.error("Resource %s is not dictionary" % resource)
+            raise e
 
-            # in some responses first value is `count` of all values:
-            # http://vk.com/developers.php?oid=-1&p=groups.search
-            if isinstance(resource, int):
-                continue
+    def get_response_resources(self, response_list):
+        resources = [self.get_response_resource(resource) for resource in response_list]
+        return [resource for resource in resources if resource is not None]
 
-            try:
-                resource = dict(resource)
-            except (TypeError, ValueError) as e:
-                log.error("Resource %s is not dictionary" % resource)
-                raise e
+    def parse_response_list(self, response_list, extra_fields=None):
+
+        resources = self.get_response_resources(response_list)
+        self.model.prepare_resources(resources)
 
+        instances = []
+        for resource in resources:
             instance = self.parse_response_dict(resource, extra_fields)
             instances += [instance]
 
         return instances
 
+    def parse_response_records(self, response_list, extra_fields=None):
+        return [self.model.parse_record(resource, extra_fields)
+                for resource in self.get_response_resources(response_list)]
+
 
 class VkontakteTimelineManager(VkontakteManager):
 
     """
     Manager class, child of VkontakteManager for fetching objects with arguments `after`, `before`
+    and `incremental` for fetching only new objects, using VkontakteSyncState
     """
     timeline_cut_fieldname = 'date'
     timeline_force_ordering = False
+    fetch_options = ('bulk', 'after', 'before', 'incremental')
 
     def get_timeline_date(self, instance):
         return getattr(instance, self.timeline_cut_fieldname, datetime(1970, 1, 1).replace(tzinfo=timezone.utc))
 
-    @atomic
+    def get_sync_owner(self, kwargs):
+        """
+        Return owner of timeline from arguments of API call. Can be overrided in child managers
+        """
+        return unicode(kwargs.get('owner_id', ''))
+
+    def get_sync_state(self, kwargs):
+        state = VkontakteSyncState.objects.get_or_create(
+            model='%s.%s' % (self.model._meta.app_label, self.model._meta.object_name),
+            owner=self.get_sync_owner(kwargs),
+            method=kwargs.get('method', 'get'))[0]
+        state.offset = int(kwargs.get('offset', 0))
+        return state
+
+    def seek_offset(self, date, *args, **kwargs):
+        """
+        Return offset of the first item of timeline, which is not later than `date`.
+        Offset is found by binary search with API calls for single items, using total count of items.
+        Timeline should be ordered from new to old items
+        """
+        kwargs['count'] = 1
+
+        def get_item(offset):
+            kwargs['offset'] = offset
+            result = self.get(*args, **kwargs)
+            return result[0] if len(result) else None, getattr(result, 'total_count', None)
+
+        item, total_count = get_item(0)
+        if item is None or self.get_timeline_date(item) <= date:
+            return 0
+        if not total_count:
+            log.warning("Impossible to seek offset of timeline without total count of items, model %s" %
+                        self.model.__name__)
+            return 0
+
+        # item before `low` is later than date, item on `high` is not later than date or absent
+        low, high = 1, total_count
+        while low < high:
+            middle = (low + high) // 2
+            item = get_item(middle)[0]
+            if item is None or self.get_timeline_date(item) <= date:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
     def fetch(self, *args, **kwargs):
         """
-        Retrieve and save object to local DB
+        With argument `seek=True` and `before` the first page is fetched from offset, found by seek_offset().
+        Offset of the page is returned in attribute `offset` of result
+        """
+        offset = None
+        if kwargs.pop('seek', False) and kwargs.get('before') and not kwargs.get('offset'):
+            seek_kwargs = dict([(key, value) for key, value in kwargs.items() if key not in self.fetch_options])
+            offset = kwargs['offset'] = self.seek_offset(kwargs['before'], *args, **seek_kwargs)
+
+        result = super(VkontakteTimelineManager, self).fetch(*args, **kwargs)
+        if offset is not None:
+            result.offset = offset
+        return result
+
+    def pop_fetch_options(self, kwargs):
+        options = super(VkontakteTimelineManager, self).pop_fetch_options(kwargs)
+        if options.pop('incremental', False):
+            options['sync_state'] = self.get_sync_state(kwargs)
+        return options
+
+    def save_result(self, result, after=None, before=None, bulk=None, sync_state=None):
+        """
+        Save result of method get() to local DB
         Return queryset with respect to parameters:
          * 'after' - excluding all items before.
          * 'before' - excluding all items after.
+         * 'sync_state' - excluding known items, saved before, and all items after them.
         """
-        after = kwargs.pop('after', None)
-        before = kwargs.pop('before', None)
-
-        result = self.get(*args, **kwargs)
-        if isinstance(result, list):
-            instances = self.model.objects.none()
+        bulk = self.bulk if bulk is None else bulk
+        if isinstance(result, (list, VkontakteResponseStream)):
+            pks = []
+            saved = []
+            instances_bulk = []
+            listened = vkontakte_api_post_fetch_batch.has_listeners(self.model)
+            # total count of streamed response is known after reading
+            response = result
+            # items of page and flag of reaching of known items for sync state
+            items = []
+            reached = False
 
             if self.timeline_force_ordering:
-                result.sort(key=self.get_timeline_date, reverse=True)
+                result = sorted(result, key=self.get_timeline_date, reverse=True)
 
             for instance in result:
 
@@ -276,13 +739,47 @@ class VkontakteTimelineManager(VkontakteManager):
                     if before and before < timeline_date:
                         continue
 
+                if sync_state:
+                    items += [(instance.remote_id, timeline_date)]
+                    if sync_state.is_head(instance.remote_id):
+                        reached = True
+                        continue
+                    if sync_state.is_older(timeline_date):
+                        reached = True
+                        break
+
+                if bulk:
+                    instances_bulk += [instance]
+                    continue
+
                 instance = self.get_or_create_from_instance(instance)
-                instances |= instance.__class__.objects.filter(pk=instance.pk)
+                pks += [instance.pk]
+                if listened:
+                    saved += [instance]
+
+            if isinstance(response, VkontakteResponseStream):
+                # reading of response could be stopped before the end
+                response.close()
+
+            if bulk:
+                instances = self.get_or_create_from_instances(instances_bulk)
+            else:
+                instances = self.model.objects.filter(pk__in=pks)
+                self.send_post_fetch_batch(instances, saved)
+            instances.total_count = getattr(response, 'total_count', None)
+
+            if sync_state:
+                end = not items or (instances.total_count is not None and
+                                    sync_state.offset + len(items) >= instances.total_count)
+                sync_state.register_page(items, reached or end)
+
             return instances
         elif isinstance(result, QuerySet):
             return result
         else:
-            return self.get_or_create_from_instance(result)
+            instance = self.get_or_create_from_instance(result)
+            self.send_post_fetch_batch([instance], [instance])
+            return instance
 
 
 class VkontakteModel(models.Model):
@@ -294,6 +791,8 @@ class VkontakteModel(models.Model):
     remote_pk_local_field = 'remote_id'
     methods_access_tag = ''
     methods_namespace = ''
+    # name of field for hash of API resource. Unchanged objects are not saved while fetching
+    content_hash_field = None
 
     fetched = models.DateTimeField(u'Обновлено', null=True, blank=True, db_index=True)
 
@@ -309,86 +808,103 @@ class VkontakteModel(models.Model):
         """
         self.pk = old_instance.pk
 
+    @classmethod
+    def prepare_resources(cls, resources):
+        """
+        Prepare all resources of response before parsing of each one, for example get related objects by bulk queries.
+        Can be overrided in child models
+        """
+        pass
+
     def save(self, *args, **kwargs):
         try:
             return super(VkontakteModel, self).save(*args, **kwargs)
         except Exception as e:
             six.reraise(type(e), '%s while saving %s' % (str(e), self.__dict__), sys.exc_info()[2])
 
-    def parse(self, response):
+    @classmethod
+    def get_parse_plan(cls):
         """
-        Parse API response and define fields with values
+        Return dict of keys of API response with names of fields and converters of values.
+        Plan is filled once for each key and model
         """
-        for key, value in response.items():
-            if key == self.remote_pk_field:
-                key = self.remote_pk_local_field
-                value = int(value)
+        if '_parse_plan' not in cls.__dict__:
+            cls._parse_plan = {}
+        return cls._parse_plan
+
+    @classmethod
+    def get_parse_plan_item(cls, key):
+        converters = ()
+        if key == cls.remote_pk_field:
+            key = cls.remote_pk_local_field
+            converters = (convert_int,)
+
+        try:
+            field = cls._meta.get_field(key)
+        except FieldDoesNotExist:
+            return None, ()
+
+        return key, converters + get_field_converters(field)
 
+    @classmethod
+    def parse_values(cls, response, instance):
+        """
+        Iterate names of fields and converted values of API response
+        """
+        plan = cls.get_parse_plan()
+        for key, value in response.items():
             try:
-                field = self._meta.get_field(key)
-            except FieldDoesNotExist:
-                log.debug('Field with name "%s" doesn\'t exists in the model %s' % (key, self.__class__.__name__))
+                name, converters = plan[key]
+            except KeyError:
+                name, converters = plan[key] = cls.get_parse_plan_item(key)
+
+            if name is None:
+                log.debug('Field with name "%s" doesn\'t exists in the model %s', key, cls.__name__)
                 continue
 
-            if isinstance(field, models.IntegerField) and value:
-                try:
-                    value = int(value)
-                except ValueError:
-                    pass
-                if isinstance(field, models.PositiveIntegerField):
-                    value = value if value > 0 else 0
-            elif isinstance(field, models.FloatField) and value:
-                try:
-                    value = float(value)
-                except ValueError:
-                    pass
-            elif isinstance(field, models.CharField):
-                if isinstance(value, bool):
-                    value = ''
-                else:
-                    try:
-                        value = unicode(value)
-                    except:
-                        pass
+            for converter in converters:
+                value = converter(value, instance)
 
-            elif isinstance(field, models.DateTimeField):
-                try:
-                    value = int(value)
-                    assert value > 0
-                    value = datetime.utcfromtimestamp(value).replace(tzinfo=timezone.utc)
-                except:
-                    value = None
-            elif isinstance(field, models.DateField):
-                try:
-                    # TODO: define tzinfo here
-                    value = date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
-                except:
-                    value = None
-
-            if isinstance(field, models.OneToOneField) and value:
-                rel_class = field.rel.to
-                if isinstance(value, int):
-                    try:
-                        rel_instance = rel_class.objects.get(pk=value)
-                    except rel_class.DoesNotExist:
-                        raise VkontakteParseError("OneToOne relation of model %s (PK=%s) does not exist" %
-                                                  (rel_class.__name__, value))
-                else:
-                    rel_instance = rel_class().parse(dict(value))
-                value = rel_instance
+            yield name, value
 
-            if isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)) and isinstance(value, list):
-                value = ','.join([unicode(v) for v in value])
+    @classmethod
+    def get_content_hash(cls, response):
+        """
+        Return hash of normalized API response
+        """
+        return md5(json.dumps(response, sort_keys=True, separators=(',', ':'), default=unicode)).hexdigest()
 
-            if isinstance(field, fields.JSONField):
-                try:
-                    field.validate(value, self)
-                except ValidationError:
-                    log.warning("Can not validate json field %s with value %s in the model %s" % (
-                        key, value, self.__class__.__name__))
-                    value = ''
+    def is_content_unchanged(self, old_instance):
+        if not self.content_hash_field:
+            return False
+        content_hash = getattr(self, self.content_hash_field)
+        return content_hash is not None and content_hash == getattr(old_instance, self.content_hash_field)
 
-            setattr(self, key, value)
+    def parse(self, response):
+        """
+        Parse API response and define fields with values
+        """
+        for name, value in self.parse_values(response, self):
+            setattr(self, name, value)
+
+    @classmethod
+    def get_record_class(cls):
+        if '_record_class' not in cls.__dict__:
+            names = tuple([field.name for field in cls._meta.concrete_fields])
+            cls._record_class = type(str('%sRecord' % cls.__name__), (VkontakteRecord,), {'__slots__': names})
+        return cls._record_class
+
+    @classmethod
+    def parse_record(cls, response, extra_fields=None):
+        """
+        Parse API response to lightweight record with the same values of fields, as in parsed instance
+        """
+        record = cls.get_record_class()(**(extra_fields or {}))
+        names = record.__slots__
+        for name, value in cls.parse_values(response, record):
+            if name in names:
+                setattr(record, name, value)
+        return record
 
     def refresh(self):
         """
@@ -434,8 +950,19 @@ class VkontakteIDModel(RemoteIdModelMixin, VkontakteModel):
 
     def save(self, *args, **kwargs):
         """
-        In case of IntegrityError, caused by `remote_id` field make substitution and save again
+        In case of IntegrityError, caused by `remote_id` field make substitution and save again.
+        With setting VKONTAKTE_API_NATIVE_UPSERT new instance is inserted or updated by `remote_id` with one statement
+        without substitution, if database supports it
         """
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        if NATIVE_UPSERT and self.pk is None and self.remote_id and not args and not set(kwargs) - set(['using']) \
+                and is_upsert_supported(self.__class__, using):
+            signals.pre_save.send(sender=self.__class__, instance=self, raw=False, using=using, update_fields=None)
+            created = upsert(self.__class__, [self], using)[0]
+            signals.post_save.send(sender=self.__class__, instance=self, created=created, update_fields=None,
+                                   raw=False, using=using)
+            return
+
         try:
             with atomic():
                 return super(VkontakteIDModel, self).save(*args, **kwargs)
@@ -482,6 +1009,10 @@ class VkontakteCRUDModel(models.Model):
     # flag should we update model remotely on save() and delete() methods
     _commit_remote = True
 
+    # save only changed fields of instance, loaded from DB or substituted by manager. Changed fields are defined
+    # after sending of signal pre_save, so fields, changed by receivers and save() methods of parent classes, are saved
+    update_changed_fields = True
+
     archived = models.BooleanField(u'В архиве', default=False)
 
     class Meta:
@@ -490,6 +1021,58 @@ class VkontakteCRUDModel(models.Model):
     def __init__(self, *args, **kwargs):
         self._commit_remote = kwargs.pop('commit_remote', self._commit_remote)
         super(VkontakteCRUDModel, self).__init__(*args, **kwargs)
+        # values of fields, loaded from DB. None if instance was not loaded
+        self._loaded_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Called since Django 1.8, in older versions values are read from DB by get_loaded_values()
+        """
+        instance = super(VkontakteCRUDModel, cls).from_db(db, field_names, values)
+        instance._loaded_values = copy.deepcopy(dict(zip(field_names, values)))
+        return instance
+
+    def get_field_values(self):
+        # the same as Model.get_deferred_fields() of Django 1.8
+        deferred = [field.attname for field in self._meta.concrete_fields
+                    if isinstance(self.__class__.__dict__.get(field.attname), DeferredAttribute)]
+        return dict([(field.attname, getattr(self, field.attname)) for field in self._meta.concrete_fields
+                     if field.attname not in deferred])
+
+    def get_loaded_values(self):
+        """
+        Return dict of values of fields, loaded from DB.
+        Values are read from DB only for instances, that was not loaded from DB, for example substituted by manager
+        """
+        if self._loaded_values is None and self.pk:
+            try:
+                self._loaded_values = self.__class__.objects.get(pk=self.pk).get_field_values()
+            except self.__class__.DoesNotExist:
+                self._loaded_values = {}
+        return self._loaded_values or {}
+
+    def get_changed_fields(self):
+        """
+        Return list of names of fields with values, different from loaded from DB
+        """
+        loaded = self.get_loaded_values()
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in loaded and getattr(self, field.attname) != loaded[field.attname]]
+
+    def _substitute(self, old_instance):
+        super(VkontakteCRUDModel, self)._substitute(old_instance)
+        # values are compared with values of old instance without reading them from DB again
+        self._loaded_values = copy.deepcopy(old_instance.get_field_values())
+
+    def get_loaded_instance(self):
+        """
+        Return new instance with values of fields, loaded from DB
+        """
+        instance = self.__class__(**self.get_loaded_values())
+        instance._state.adding = False
+        instance._state.db = self._state.db
+        return instance
 
     def delete(self, commit_remote=None, *args, **kwargs):
         if not self.archived:
@@ -509,7 +1092,25 @@ class VkontakteCRUDModel(models.Model):
                 self.create_remote(**kwargs)
             elif self.pk and self.fields_changed:
                 self.update_remote(**kwargs)
-        super(VkontakteCRUDModel, self).save(*args, **kwargs)
+
+        # update only changed fields of loaded instance, they are defined by _save_table() after signal pre_save
+        self._update_changed_fields = self.update_changed_fields and self.pk and self._loaded_values and not args \
+            and 'update_fields' not in kwargs and not kwargs.get('force_insert')
+        try:
+            super(VkontakteCRUDModel, self).save(*args, **kwargs)
+        finally:
+            self._update_changed_fields = False
+        self._loaded_values = copy.deepcopy(self.get_field_values())
+
+    def _save_table(self, raw=False, cls=None, force_insert=False, force_update=False, using=None,
+                    update_fields=None):
+        if getattr(self, '_update_changed_fields', False) and update_fields is None and not force_insert:
+            changed = self.get_changed_fields()
+            if self._meta.pk.name not in changed:
+                # with the only primary key in update_fields nothing is updated
+                update_fields = frozenset(changed + [field.name for field in self._meta.concrete_fields
+                                                     if getattr(field, 'auto_now', False)] or [self._meta.pk.name])
+        return super(VkontakteCRUDModel, self)._save_table(raw, cls, force_insert, force_update, using, update_fields)
 
     def create_remote(self, **kwargs):
         params = self.prepare_create_params(**kwargs)
@@ -575,14 +1176,13 @@ class VkontakteCRUDModel(models.Model):
 
     @property
     def fields_changed(self):
-        old = self.__class__.objects.get(remote_id=self.remote_id)
-        return old.__dict__ != self.__dict__
+        return len(self.get_changed_fields()) > 0
 
     def prepare_update_params_distinct(self, **kwargs):
         """
         Return dict with distinct set of fields for update
         """
-        old = self.__class__.objects.get(remote_id=self.remote_id)
+        old = self.get_loaded_instance()
         fields_new = self.prepare_update_params(**kwargs).items()
         fields_old = old.prepare_update_params(**kwargs).items()
         fields = dict(set(fields_new).difference(set(fields_old)))
@@ -647,3 +1247,53 @@ class VkontakteCRUDModel(models.Model):
             return False
         else:
             return True
+
+
+class VkontakteSyncState(models.Model):
+    """
+    State of incremental fetching of timeline: the newest date of fetched items and remote ids of items
+    on the head of timeline. New state is pending until fetching reaches known items or the end of timeline
+    """
+    model = models.CharField(u'Модель', max_length=100)
+    owner = models.CharField(u'Владелец', max_length=100)
+    method = models.CharField(u'Метод', max_length=100)
+
+    cut = models.DateTimeField(u'Дата последнего элемента', null=True)
+    head_ids = models.TextField(u'ID первых элементов', blank=True)
+    pending_cut = models.DateTimeField(null=True)
+    pending_head_ids = models.TextField(blank=True)
+
+    updated = models.DateTimeField(u'Обновлено', auto_now=True)
+
+    # offset of the current page
+    offset = 0
+
+    class Meta:
+        unique_together = ('model', 'owner', 'method')
+
+    def __unicode__(self):
+        return '%s %s %s: %s' % (self.model, self.owner, self.method, self.cut)
+
+    def is_head(self, remote_id):
+        return unicode(remote_id) in self.head_ids.split(',')
+
+    def is_older(self, date):
+        return self.cut is not None and isinstance(date, datetime) and date < self.cut
+
+    def register_page(self, items, finished):
+        """
+        Remember items of the first page as pending state, make it actual after reaching known items
+        or the end of timeline
+        """
+        if self.offset == 0 and items:
+            dates = [date for remote_id, date in items if isinstance(date, datetime)]
+            self.pending_cut = max(dates) if dates else None
+            self.pending_head_ids = ','.join([unicode(remote_id) for remote_id, date in items])
+
+        if finished and self.pending_cut:
+            self.cut = max(self.cut, self.pending_cut) if self.cut else self.pending_cut
+            self.head_ids = self.pending_head_ids
+            self.pending_cut = None
+            self.pending_head_ids = ''
+
+        self.save()
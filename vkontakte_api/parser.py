@@ -4,10 +4,12 @@ import re
 
 from bs4 import BeautifulSoup
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-import requests
 import simplejson as json
 
+from .sessions import get_session
+
 
 def isalambda(v):
     return isinstance(v, type(lambda: None)) and v.__name__ == '<lambda>'
@@ -60,9 +62,9 @@ class VkontakteParser(object):
             args[0] = 'http://vk.com' + args[0]
 
         if 'method' in kwargs and kwargs.pop('method') == 'get':
-            response = requests.get(*args, **kwargs)
+            response = get_session().get(*args, **kwargs)
         else:
-            response = requests.post(*args, **kwargs)
+            response = get_session().post(*args, **kwargs)
 
         self.content = response.content.decode('windows-1251')
         return self
@@ -126,11 +128,15 @@ class VkontakteParser(object):
         from vkontakte_users.models import User
 
         items = self.content_bs.findAll(*users)
+        containers = []
         for item in items:
             user_link_container = user_link(item) if isalambda(user_link) else item.find(*user_link)
             user_photo_container = user_photo(item) if isalambda(user_photo) else item.find(*user_photo)
+            containers += [(user_link_container, user_photo_container)]
 
-            user = User.remote.get_by_slug(user_link_container['href'][1:])
+        users = User.remote.get_by_slugs([link['href'][1:] for link, photo in containers])
+        for user_link_container, user_photo_container in containers:
+            user = users[user_link_container['href'][1:]]
             if user:
                 user.set_name(user_link_container.text)
                 user.photo = user_photo_container['src']
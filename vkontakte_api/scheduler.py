@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler of refreshing of stale objects by indexed field `fetched`. The most overdue and popular objects
+are refreshed first by batched calls of VkontakteManager.fetch_ids() within budget of API calls per minute
+"""
+from datetime import timedelta
+import logging
+import math
+
+from django.conf import settings
+from django.db.models.fields import FieldDoesNotExist
+from django.utils import timezone
+
+from .api import TokenBucketRateLimiter
+
+__all__ = ['RefreshScheduler']
+
+log = logging.getLogger('vkontakte_api')
+
+# API calls per minute for refreshing of objects
+REFRESH_BUDGET = getattr(settings, 'VKONTAKTE_API_REFRESH_BUDGET', 60)
+# seconds after fetching, when object should be refreshed
+REFRESH_EXPIRES = getattr(settings, 'VKONTAKTE_API_REFRESH_EXPIRES', 24 * 60 * 60)
+
+
+class RefreshScheduler(object):
+    """
+    Refresh stale objects of the model. Never fetched objects are the first, ordered by popularity. Priority of others
+    is the time since it was fetched, multiplied by logarithm of popularity - sum of values of `popularity_fields`.
+    Each batch of `chunk` objects is refreshed by one call of manager `remote`
+    """
+    popularity_fields = ('likes_count', 'actions_count')
+    # number of stale objects, selected for prioritizing, in relation to number of refreshed objects
+    candidates_factor = 10
+
+    def __init__(self, model, expires=None, budget=None, chunk=None, popularity_fields=None, **kwargs):
+        self.model = model
+        self.manager = model.remote
+        self.expires = REFRESH_EXPIRES if expires is None else expires
+        self.budget = budget or REFRESH_BUDGET
+        self.chunk = chunk or self.manager.ids_chunk
+        self.kwargs = kwargs
+        self.limiter = TokenBucketRateLimiter(self.budget / 60., burst=1)
+
+        popularity_fields = self.popularity_fields if popularity_fields is None else popularity_fields
+        self.popularity_fields = [name for name in popularity_fields if self.has_field(name)]
+
+    def has_field(self, name):
+        try:
+            self.model._meta.get_field(name)
+            return True
+        except FieldDoesNotExist:
+            return False
+
+    def get_queryset(self):
+        """
+        Return queryset of expired objects from the most overdue
+        """
+        expired = timezone.now() - timedelta(seconds=self.expires)
+        return self.model.objects.filter(fetched__lt=expired).order_by('fetched')
+
+    def get_unfetched_queryset(self):
+        """
+        Return queryset of never fetched objects. It's separate from get_queryset(),
+        because databases put NULL values in different places of ordering
+        """
+        return self.model.objects.filter(fetched__isnull=True)
+
+    def get_priority(self, fetched, popularity, now):
+        popularity = math.log(2 + sum([value or 0 for value in popularity]))
+        if fetched is None:
+            return (True, popularity)
+        return (False, (now - fetched).total_seconds() * popularity)
+
+    def get_stale_ids(self, limit):
+        """
+        Return list of remote ids of `limit` stale objects, ordered by priority
+        """
+        fields = ['remote_id', 'fetched'] + self.popularity_fields
+        candidates = list(self.get_unfetched_queryset().values_list(*fields)[:limit * self.candidates_factor])
+        if len(candidates) < limit:
+            candidates += list(self.get_queryset().values_list(*fields)[:limit * self.candidates_factor])
+        now = timezone.now()
+        candidates = sorted(candidates, key=lambda values: self.get_priority(values[1], values[2:], now), reverse=True)
+        return [values[0] for values in candidates[:limit]]
+
+    def run(self, calls=None):
+        """
+        Refresh stale objects by `calls` batched calls (by default number of calls per minute).
+        Return number of objects, selected for refreshing
+        """
+        calls = calls or self.budget
+        ids = self.get_stale_ids(calls * self.chunk)
+        for i in range(0, len(ids), self.chunk):
+            self.limiter.acquire(self.model)
+            self.manager.fetch_ids(ids[i:i + self.chunk], chunk=self.chunk, expires=0, **self.kwargs)
+
+        log.debug('Refreshed %d stale objects %s' % (len(ids), self.model))
+        return len(ids)
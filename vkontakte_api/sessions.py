@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from django.conf import settings
+from django.utils.six.moves.http_cookiejar import CookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+
+__all__ = ['get_session', 'get_pool_stats']
+
+POOL_CONNECTIONS = getattr(settings, 'VKONTAKTE_API_HTTP_POOL_CONNECTIONS', 10)
+POOL_MAXSIZE = getattr(settings, 'VKONTAKTE_API_HTTP_POOL_MAXSIZE', 10)
+
+lock = threading.Lock()
+session = None
+
+
+class RejectCookiesPolicy(CookiePolicy):
+    """
+    Cookies of responses are not kept by the session, because it's shared by calls with different tokens.
+    Cookies, passed to a request by argument, are sent as usual
+    """
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+
+def get_session():
+    """
+    Return HTTP session with pools of keep-alive connections, shared by API client and parser
+    """
+    global session
+    with lock:
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.cookies.set_policy(RejectCookiesPolicy())
+            for prefix in ['http://', 'https://']:
+                session.mount(prefix, HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE))
+    return session
+
+
+def get_pool_stats():
+    """
+    Return statistics of connection pools of the session: number of requests, opened and reused connections
+    """
+    stats = {'requests': 0, 'opened': 0, 'reused': 0}
+    for adapter in set(get_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['opened'] += pool.num_connections
+    stats['reused'] = stats['requests'] - stats['opened']
+    return stats
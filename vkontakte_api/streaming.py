@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental decoding of API responses from HTTP body. Requires package ijson,
+without it responses are decoded entirely with the same interface
+"""
+from decimal import Decimal
+import json
+import sys
+
+from django.utils import six
+from vkontakte import VKError as VkontakteError
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+__all__ = ['StreamedResponse']
+
+
+class StreamedResponse(object):
+    """
+    Response of API, decoded from file-like object. Iterating yields resources of response one by one:
+    items of list, items of dict with `items` or dict itself. Value of `count` is available as `total_count`.
+    Error of API is raised while creating of instance, before reading of response.
+    Body is closed by `close` callable (by default method of fileobj) after iterating or on stopping of it
+    """
+    def __init__(self, fileobj, close=None):
+        self.total_count = None
+        # errors of failed calls of method `execute`, available after reading of response
+        self.execute_errors = []
+        self.close_body = close or getattr(fileobj, 'close', None)
+        if ijson:
+            self.events = self.get_events(fileobj)
+            self.resources = self.read_events()
+        else:
+            self.resources = self.read_decoded(json.loads(fileobj.read()))
+        # read response until start of value of `response` for raising errors
+        try:
+            next(self.resources)
+        except Exception:
+            exc_info = sys.exc_info()
+            self.close()
+            six.reraise(*exc_info)
+
+    def __iter__(self):
+        try:
+            for resource in self.resources:
+                yield resource
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Close body of response. Connection with not read rest of body is discarded instead of returning to pool
+        """
+        self.resources.close()
+        if self.close_body:
+            self.close_body()
+            self.close_body = None
+
+    def get_events(self, fileobj):
+        for prefix, event, value in ijson.parse(fileobj):
+            if event == 'number' and isinstance(value, Decimal):
+                value = float(value)
+            yield prefix, event, value
+
+    def build(self, event, value):
+        """
+        Build object, starting from the event, from the next events
+        """
+        builder = ObjectBuilder()
+        builder.event(event, value)
+        depth = 1 if event in ('start_map', 'start_array') else 0
+        while depth:
+            prefix, event, value = next(self.events)
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+        return builder.value
+
+    def read_events(self):
+        for prefix, event, value in self.events:
+            if prefix == '' and event == 'map_key':
+                if value == 'error':
+                    raise VkontakteError(self.build(*next(self.events)[1:]))
+                elif value == 'execute_errors':
+                    self.execute_errors = self.build(*next(self.events)[1:])
+                elif value == 'response':
+                    break
+        else:
+            raise VkontakteError({'error_code': 0, 'error_msg': "Empty response", 'request_params': {}})
+
+        # there is a value of `None` before the first resource
+        yield None
+
+        prefix, event, value = next(self.events)
+        if event == 'start_array':
+            for resource in self.read_array():
+                yield resource
+        elif event == 'start_map':
+            # dict without `items` is yielded itself
+            resource = {}
+            for prefix, event, value in self.events:
+                if event == 'end_map':
+                    break
+                key = value
+                prefix, event, value = next(self.events)
+                if key == 'items' and event == 'start_array':
+                    resource = None
+                    for item in self.read_array():
+                        yield item
+                elif key == 'count':
+                    self.total_count = value
+                elif resource is not None:
+                    resource[key] = self.build(event, value)
+                else:
+                    self.build(event, value)
+            if resource is not None:
+                if self.total_count is not None:
+                    resource['count'] = self.total_count
+                    self.total_count = None
+                yield resource
+        else:
+            yield value
+
+        # read the rest of body for releasing of connection
+        for prefix, event, value in self.events:
+            if prefix == '' and event == 'map_key' and value == 'execute_errors':
+                self.execute_errors = self.build(*next(self.events)[1:])
+
+    def read_array(self):
+        for prefix, event, value in self.events:
+            if event == 'end_array':
+                break
+            yield self.build(event, value)
+
+    def read_decoded(self, data):
+        if 'error' in data:
+            raise VkontakteError(data['error'])
+        self.execute_errors = data.get('execute_errors', [])
+
+        yield None
+
+        response = data.get('response')
+        if isinstance(response, dict) and 'items' in response:
+            self.total_count = response.get('count')
+            response = response['items']
+
+        if isinstance(response, list):
+            for resource in response:
+                yield resource
+        else:
+            yield response
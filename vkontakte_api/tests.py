@@ -1,12 +1,48 @@
 # -*- coding: utf-8 -*-
-from django.db import models, IntegrityError
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import BytesIO
+import json
+import sqlite3
+import threading
+import types
+import unittest
+
+import django
+from django.core.management import call_command
+from django.db import connection, models, transaction, IntegrityError
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from social_api.api import override_api_context
 from social_api.testcase import SocialApiTestCase
 import mock
 
-from .api import api_call, VkontakteApi
-from .decorators import opt_generator
-from .models import VkontakteIDModel, VkontaktePKModel, VkontakteManager
+from .api import (api_call, batch, AccessTokenPool, ExecuteResponse, SessionAPI, TokenBucketRateLimiter, VkontakteApi,
+                  VkontakteError)
+from .cache import DjangoCache, LocalCache
+from .decorators import fetch_all, memoize, opt_generator
+from .models import (VkontakteCRUDManager, VkontakteCRUDModel, VkontakteIDModel, VkontaktePKModel, VkontakteManager,
+                     VkontakteResponseList, VkontakteSyncState, VkontakteTimelineManager)
 from .parser import VkontakteParser
+from .scheduler import RefreshScheduler
+from .sessions import get_pool_stats, get_session
+from .upsert import is_upsert_supported
+from .utils import diff_sorted_ids, get_pks_lookup
+from . import streaming
+from .signals import vkontakte_api_post_fetch, vkontakte_api_post_fetch_batch
+
+try:
+    from .mixins import LikableModelMixin
+except ImportError:
+    LikableModelMixin = None
+
+try:
+    from tornado import gen
+    from tornado.ioloop import IOLoop
+    from .aio import api_call as async_api_call, AsyncVkontakteApi
+except ImportError:
+    IOLoop = None
 
 
 TOKEN = '33af136bd445c28075f429fdb2fb9387db8fdd2d2d118c1653a4d6507f76460fce35a08b94e745eac1807'
@@ -27,8 +63,125 @@ class User(VkontaktePKModel):
     })
 
 
+class UserIDRemoteManager(VkontakteManager):
+
+    @fetch_all(default_count=2, concurrency=3)
+    def fetch_search(self, count=2, offset=0):
+        return self.fetch(method='search', count=count, offset=offset)
+
+    @fetch_all(default_count=2, return_all=lambda self, **kwargs: self.model.objects.all())
+    def fetch_search_all(self, count=2, offset=0):
+        return self.fetch(method='search', count=count, offset=offset)
+
+
 class UserID(VkontakteIDModel):
     screen_name = models.CharField(u'Короткое имя группы', max_length=50, unique=True)
+    followers_count = models.PositiveIntegerField(null=True)
+    last_seen = models.DateTimeField(null=True)
+    langs = models.CommaSeparatedIntegerField(max_length=100, blank=True)
+    content_hash = models.CharField(max_length=32, null=True)
+
+    content_hash_field = 'content_hash'
+
+    remote = UserIDRemoteManager(remote_pk=('remote_id',), version=5.27, methods={
+        'get': 'users.get',
+        'search': 'users.search',
+    })
+
+
+class LikableUserID(UserID):
+    """
+    Parsing pops values from resource, like mixins LikableModelMixin, AuthorableModelMixin do
+    """
+    remote = UserIDRemoteManager(remote_pk=('remote_id',), version=5.27, methods={'get': 'users.get'})
+
+    class Meta:
+        proxy = True
+
+    def parse(self, response):
+        if 'likes' in response:
+            self.followers_count = response.pop('likes')['count']
+        super(LikableUserID, self).parse(response)
+
+
+class Post(VkontakteIDModel):
+    date = models.DateTimeField(null=True)
+    text = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, null=True)
+
+    remote = VkontakteTimelineManager(remote_pk=('remote_id',), version=5.27, methods={'get': 'wall.get'})
+
+
+class Note(VkontakteCRUDModel, VkontakteIDModel):
+    title = models.CharField(max_length=100)
+    text = models.TextField()
+
+    fields_required_for_update = ['note_id']
+
+    objects = VkontakteCRUDManager()
+    remote = VkontakteManager(remote_pk=('remote_id',), version=5.27, methods_namespace='notes')
+
+    def prepare_create_params(self, **kwargs):
+        return {'title': self.title, 'text': self.text}
+
+    def prepare_update_params(self, **kwargs):
+        return {'note_id': self.remote_id, 'title': self.title, 'text': self.text}
+
+    def prepare_delete_params(self):
+        return {'note_id': self.remote_id}
+
+    def parse_remote_id_from_response(self, response):
+        return response
+
+
+class StandInApiRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handler of local HTTP server, responding with the next of prepared responses
+    """
+    protocol_version = 'HTTP/1.1'
+    responses = []
+    requests = []
+    clients = []
+    cookies = []
+
+    def do_POST(self):
+        self.requests.append((self.path, self.rfile.read(int(self.headers['Content-Length']))))
+        self.clients.append(self.client_address)
+        self.cookies.append(self.headers.get('Cookie'))
+        content = json.dumps(self.responses.pop(0)).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Set-Cookie', 'remixlang=0; path=/')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class StandInApiServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server instead of API server, running in a thread
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInApiRequestHandler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/method/' % self.server_port
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
 
 
 class VkontakteApiTestCase(SocialApiTestCase):
@@ -43,6 +196,13 @@ class VkontakteApiTest(VkontakteApiTestCase):
 
         self.assertEqual(id(VkontakteApi()), id(VkontakteApi()))
 
+        # separate instance for each thread
+        instances = []
+        thread = threading.Thread(target=lambda: instances.append(VkontakteApi()))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(id(VkontakteApi()), id(instances[0]))
+
     @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: {'items': []})
     def test_api_call_versions(self, method):
 
@@ -62,6 +222,605 @@ class VkontakteApiTest(VkontakteApiTestCase):
         self.assertEqual(method.call_args_list[3][0][0], 'friends.get')
         self.assertEqual(method.call_args_list[3][1]['v'], 5.03)
 
+    @mock.patch('vkontakte_api.api.api_call')
+    def test_batch_api_call(self, method):
+
+        method.return_value = ExecuteResponse([{'count': 1, 'items': [{'id': 1, 'screen_name': 'durov'}]}, False],
+                                              [{'method': 'resolveScreenName', 'error_code': 15,
+                                                'error_msg': 'Access denied'}])
+
+        with batch() as b:
+            users = b.get(User.remote, user_ids=[1])
+            resolved = b.add('resolveScreenName', screen_name='unknown')
+
+        # error of failed call is taken from execute_errors without separate call
+        self.assertEqual(method.call_count, 1)
+        self.assertEqual(method.call_args_list[0][0][0], 'execute')
+        self.assertEqual(method.call_args_list[0][1]['v'], 5.27)
+        self.assertEqual(method.call_args_list[0][1]['code'], 'return [API.users.get({"user_ids": "1", "v": 5.27}),'
+                                                              'API.resolveScreenName({"screen_name": "unknown"})];')
+
+        self.assertEqual(len(users.result), 1)
+        self.assertEqual(users.result[0].remote_id, 1)
+        self.assertEqual(users.result[0].screen_name, 'durov')
+        self.assertTrue(users.result[0].fetched)
+        self.assertEqual(resolved.error.code, 15)
+        self.assertEqual(resolved.error.params, {'screen_name': 'unknown'})
+        self.assertRaises(VkontakteError, lambda: resolved.result)
+
+        # false without error is a response of the call
+        method.return_value = ExecuteResponse([False])
+        with batch() as b:
+            resolved = b.add('resolveScreenName', screen_name='unknown')
+        self.assertEqual(resolved.result, False)
+
+    @mock.patch('vkontakte_api.api.api_call')
+    def test_batch_api_call_short_response(self, method):
+
+        # response is shorter than list of calls, the rest of calls are executed again
+        method.side_effect = [ExecuteResponse([1]), ExecuteResponse([2, 3])]
+        with batch() as b:
+            calls = [b.add('utils.getServerTime') for i in range(3)]
+
+        self.assertEqual(method.call_count, 2)
+        self.assertEqual(method.call_args_list[1][1]['code'], 'return [API.utils.getServerTime({}),'
+                                                              'API.utils.getServerTime({})];')
+        self.assertEqual([call.result for call in calls], [1, 2, 3])
+
+        # calls are not executed at all, error instead of endless repeating
+        method.side_effect = [ExecuteResponse([])]
+        with batch() as b:
+            call = b.add('utils.getServerTime')
+        self.assertEqual(call.error.code, 0)
+        self.assertRaises(VkontakteError, lambda: call.result)
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: {'count': 3, 'items': [
+        {'id': 1, 'screen_name': 'durov'}, {'id': 2, 'screen_name': 'alexandra'}, {'id': 3, 'screen_name': 'ilya'}]})
+    def test_fetch_signals(self, method):
+
+        User.objects.create(remote_id=1, screen_name='old')
+        receiver, receiver_batch = mock.Mock(), mock.Mock()
+        vkontakte_api_post_fetch.connect(receiver, sender=User)
+        vkontakte_api_post_fetch_batch.connect(receiver_batch, sender=User)
+
+        User.remote.fetch(user_ids=[1, 2, 3])
+        self.assertEqual(receiver.call_count, 3)
+        self.assertEqual(receiver_batch.call_count, 1)
+        self.assertEqual(receiver_batch.call_args[1]['instances'].count(), 3)
+        self.assertEqual([user.remote_id for user in receiver_batch.call_args[1]['created']], [2, 3])
+        self.assertEqual([user.remote_id for user in receiver_batch.call_args[1]['updated']], [1])
+
+        # signal for each instance is disabled
+        with mock.patch('vkontakte_api.models.POST_FETCH_SIGNAL', False):
+            User.remote.fetch(user_ids=[1, 2, 3])
+        self.assertEqual(receiver.call_count, 3)
+        self.assertEqual(receiver_batch.call_count, 2)
+        self.assertEqual(len(receiver_batch.call_args[1]['updated']), 3)
+
+        vkontakte_api_post_fetch.disconnect(receiver, sender=User)
+        vkontakte_api_post_fetch_batch.disconnect(receiver_batch, sender=User)
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: [
+        {'id': 1, 'screen_name': 'durov', 'followers_count': 10}, {'id': 2, 'screen_name': 'ilya'}])
+    def test_fetch_unchanged(self, method):
+
+        UserID.remote.fetch(user_ids=[1, 2])
+        receiver = mock.Mock()
+        vkontakte_api_post_fetch.connect(receiver, sender=UserID)
+
+        # unchanged objects are not saved, only time of fetching is updated by one query inside of savepoint
+        fetched = UserID.objects.get(remote_id=1).fetched
+        with self.assertNumQueries(4):
+            users = UserID.remote.fetch(user_ids=[1, 2], bulk=True)
+        self.assertEqual(users.count(), 2)
+        self.assertGreater(UserID.objects.get(remote_id=1).fetched, fetched)
+
+        UserID.objects.filter(remote_id=1).update(followers_count=5)
+        UserID.remote.fetch(user_ids=[1, 2])
+        self.assertEqual(receiver.call_count, 0)
+        self.assertEqual(UserID.objects.get(remote_id=1).followers_count, 5)
+
+        # changed resource is saved entirely
+        method.side_effect = lambda *a, **kw: [{'id': 1, 'screen_name': 'durov', 'followers_count': 20}]
+        UserID.remote.fetch(user_ids=[1])
+        self.assertEqual(receiver.call_count, 1)
+        self.assertEqual(UserID.objects.get(remote_id=1).followers_count, 20)
+
+        vkontakte_api_post_fetch.disconnect(receiver, sender=UserID)
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: [
+        {'id': 1, 'screen_name': 'durov', 'likes': {'count': 10, 'user_likes': 0}}])
+    def test_fetch_unchanged_popped_values(self, method):
+
+        user = LikableUserID.remote.fetch(user_ids=[1])[0]
+        self.assertEqual(user.followers_count, 10)
+        self.assertEqual(user.content_hash, UserID.get_content_hash(method.side_effect()[0]))
+
+        # values, popped from resource while parsing, are part of hash
+        method.side_effect = lambda *a, **kw: [
+            {'id': 1, 'screen_name': 'durov', 'likes': {'count': 11, 'user_likes': 0}}]
+        LikableUserID.remote.fetch(user_ids=[1])
+        self.assertEqual(UserID.objects.get(remote_id=1).followers_count, 11)
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: [
+        {'id': remote_id, 'screen_name': 'user%s' % remote_id} for remote_id in kw['user_ids']])
+    def test_fetch_ids(self, method):
+        UserID.objects.create(remote_id=1, screen_name='user1', fetched=timezone.now())
+        UserID.objects.create(remote_id=2, screen_name='user2', fetched=timezone.now() - timedelta(days=2))
+
+        # not expired object is not fetched, others are fetched by chunks
+        users = UserID.remote.fetch_ids([1, 2, 3, 4, 5, 3], chunk=2, argument='user_ids')
+        self.assertEqual(users.count(), 5)
+        self.assertEqual([call[1]['user_ids'] for call in method.call_args_list], [[2, 3], [4, 5]])
+
+        method.reset_mock()
+        UserID.remote.fetch_ids([1, 2, 3], argument='user_ids', expires=0)
+        self.assertEqual([call[1]['user_ids'] for call in method.call_args_list], [[1, 2, 3]])
+
+    @mock.patch('vkontakte_api.models.api_call')
+    def test_fetch_ids_concurrency(self, method):
+        threads = set()
+
+        def response(method, user_ids, **kwargs):
+            threads.add(threading.current_thread().name)
+            threading.Event().wait(0.05)
+            return [{'id': remote_id, 'screen_name': 'user%s' % remote_id} for remote_id in user_ids]
+        method.side_effect = response
+
+        # API calls are made in threads, objects are saved in transaction of the calling thread
+        try:
+            with transaction.atomic():
+                users = UserID.remote.fetch_ids(range(10), chunk=2, concurrency=3, expires=0, argument='user_ids')
+                self.assertEqual(sorted(users.values_list('remote_id', flat=True)), list(range(10)))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(UserID.objects.count(), 0)
+        self.assertEqual(method.call_count, 5)
+        self.assertTrue(len(threads) > 1)
+        self.assertNotIn(threading.current_thread().name, threads)
+
+    @mock.patch('vkontakte_api.models.VkontakteManager.fetch_ids')
+    def test_refresh_scheduler(self, fetch_ids):
+        now = timezone.now()
+        UserID.objects.create(remote_id=1, screen_name='fresh', fetched=now)
+        UserID.objects.create(remote_id=2, screen_name='stale', fetched=now - timedelta(days=3), followers_count=0)
+        UserID.objects.create(remote_id=3, screen_name='stale popular', fetched=now - timedelta(days=2),
+                              followers_count=1000)
+        UserID.objects.create(remote_id=4, screen_name='never fetched')
+
+        scheduler = RefreshScheduler(UserID, expires=24 * 60 * 60, budget=60, chunk=2,
+                                     popularity_fields=['followers_count', 'unknown'])
+        self.assertEqual(scheduler.popularity_fields, ['followers_count'])
+        self.assertEqual(scheduler.get_stale_ids(10), [4, 3, 2])
+
+        # never fetched objects are selected separately, independently of ordering of NULL values by database
+        self.assertEqual(list(scheduler.get_queryset().values_list('remote_id', flat=True)), [2, 3])
+        scheduler.candidates_factor = 1
+        self.assertEqual(scheduler.get_stale_ids(1), [4])
+        self.assertEqual(scheduler.get_stale_ids(2), [4, 3])
+        scheduler.candidates_factor = 10
+
+        # objects are refreshed by batches of `chunk` within budget of calls
+        scheduler.limiter = mock.Mock()
+        self.assertEqual(scheduler.run(calls=1), 2)
+        self.assertEqual(scheduler.run(), 3)
+        self.assertEqual(scheduler.limiter.acquire.call_count, 3)
+        self.assertEqual([call[0][0] for call in fetch_ids.call_args_list], [[4, 3], [4, 3], [2]])
+
+        # without fields likes_count and actions_count objects are ordered only by time of fetching
+        stdout = BytesIO()
+        call_command('vkontakte_api_refresh', 'vkontakte_api.UserID', chunk=10, stdout=stdout)
+        self.assertEqual(fetch_ids.call_args[0][0], [4, 2, 3])
+        self.assertIn('Refreshed 3 stale objects of UserID', stdout.getvalue())
+
+    @unittest.skipIf(LikableModelMixin is None, "Applications vkontakte_users and m2m_history are not installed")
+    def test_fetch_likes_incremental(self):
+        from . import mixins
+
+        class Likable(object):
+            objects = mock.Mock()
+            _meta = mock.Mock()
+            likes_remote_type = 'post'
+            pk = remote_id = remote_id_short = owner_remote_id = owner = 1
+            likes_count, likes_synced_count = 4, None
+            likes_synced_count_field = 'likes_synced_count'
+            likes_users = mock.Mock()
+            save = mock.Mock()
+            fetch_likes = LikableModelMixin.__dict__['fetch_likes']
+
+        instance = Likable()
+        instance.likes_users.values_list.return_value = [1, 2]
+
+        with mock.patch.object(mixins.User, 'remote') as remote:
+            # the only added and removed likes are saved, API returned less likes than likes_count
+            remote.fetch_likes_user_ids.return_value = [4, 2, 3]
+            instance.fetch_likes(incremental=True)
+            remote.fetch_ids.assert_called_once_with([3, 4])
+            instance.likes_users.add.assert_called_once_with(3, 4)
+            instance.likes_users.remove.assert_called_once_with(1)
+            self.assertEqual(instance.likes_synced_count, 4)
+            self.assertEqual(Likable.objects.filter.return_value.update.call_args[1], {'likes_synced_count': 4})
+
+            # likes_count is not changed since the last fetching
+            instance.fetch_likes(incremental=True)
+            self.assertEqual(remote.fetch_likes_user_ids.call_count, 1)
+
+            # more likes than likes_count
+            instance.likes_count = 5
+            remote.fetch_likes_user_ids.return_value = [1, 2, 3, 4, 5, 6]
+            instance.fetch_likes(incremental=True)
+            self.assertEqual(remote.fetch_likes_user_ids.call_count, 2)
+            self.assertEqual((instance.likes_count, instance.likes_synced_count), (6, 6))
+            self.assertTrue(instance.save.called)
+
+            # without field of synced count likes are fetched entirely
+            instance.likes_synced_count_field = None
+            instance.fetch_likes(incremental=True)
+            self.assertEqual(remote.fetch_likes_user_ids.call_count, 3)
+            remote.fetch_ids.assert_called_with([1, 2, 3, 4, 5, 6])
+
+    @unittest.skipIf(LikableModelMixin is None, "Applications vkontakte_users and m2m_history are not installed")
+    def test_get_or_create_groups_and_users(self):
+        from . import mixins
+
+        # test models Post and Note are users and groups
+        groups = types.ModuleType('vkontakte_groups.models')
+        groups.Group = Note
+        modules = {'vkontakte_groups': types.ModuleType('vkontakte_groups'), 'vkontakte_groups.models': groups}
+        get_or_create = mixins.get_or_create_group_or_user
+        get_or_create.clear()
+        self.addCleanup(get_or_create.clear)
+
+        user = Post.objects.create(remote_id=1)
+        with mock.patch.object(mixins, 'User', Post), mock.patch.dict('sys.modules', modules):
+            # for users and groups: select, insert of new ones inside of savepoint, select of inserted
+            with self.assertNumQueries(10):
+                mixins.get_or_create_groups_and_users([1, 2, 3, -1, -2, 2, None, 0])
+            self.assertEqual(sorted(Post.objects.values_list('remote_id', flat=True)), [1, 2, 3])
+            self.assertEqual(sorted(Note.objects.values_list('remote_id', flat=True)), [1, 2])
+
+            # instances are remembered for get_or_create_group_or_user(), known ids are not selected again
+            group = Note.objects.get(remote_id=2)
+            with self.assertNumQueries(0):
+                self.assertEqual(get_or_create(1).pk, user.pk)
+                self.assertEqual(get_or_create(3).remote_id, 3)
+                self.assertEqual(get_or_create(-2).pk, group.pk)
+                mixins.get_or_create_groups_and_users([1, 2, -1])
+
+            # user is created by another process after selecting, error of inserting is swallowed
+            user = Post.objects.create(remote_id=4)
+            querysets = [Post.objects.none(), Post.objects.all()]
+            select = lambda **kwargs: querysets.pop(0).filter(**kwargs)
+            with mock.patch.object(Post.objects, 'filter', side_effect=select):
+                mixins.get_or_create_groups_and_users([4])
+            self.assertEqual(Post.objects.filter(remote_id=4).count(), 1)
+            with self.assertNumQueries(0):
+                self.assertEqual(get_or_create(4).pk, user.pk)
+
+    def test_diff_sorted_ids(self):
+        added, removed = diff_sorted_ids([5, 1, 3, 7], [3, 2, 8, 1, 9, 8])
+        self.assertEqual(list(added), [2, 8, 9])
+        self.assertEqual(list(removed), [5, 7])
+        self.assertEqual(list(diff_sorted_ids([], [2, 1])[0]), [1, 2])
+        self.assertEqual(list(diff_sorted_ids([2, 1], [])[1]), [1, 2])
+
+    def test_get_pks_lookup(self):
+        for remote_id in [1, 2, 3, 4, 7, 9, 10, 20]:
+            User.objects.create(remote_id=remote_id, screen_name='u%d' % remote_id)
+
+        pks = [1, 2, 3, 9, 10, 4, 20, 2]
+        lookup = get_pks_lookup(pks, chunk=2)
+        self.assertEqual(sorted(User.objects.filter(lookup).values_list('pk', flat=True)), [1, 2, 3, 4, 9, 10, 20])
+        # sequence 1..4 is selected by range, others by lists of 2 keys
+        self.assertEqual(str(lookup).count('pk__range'), 1)
+        self.assertEqual(str(lookup).count('pk__in'), 3)
+        self.assertEqual(User.objects.filter(get_pks_lookup([])).count(), 0)
+
+    @mock.patch('vkontakte_api.models.slugs_cache', LocalCache())
+    @mock.patch('vkontakte_api.api.api_call', return_value=[{'object_id': 2, 'type': 'user'}, []])
+    def test_get_by_slugs(self, method):
+
+        User.objects.create(remote_id=1, screen_name='durov')
+        User.objects.create(remote_id=3, screen_name='ilya')
+
+        # select by screen names, select by remote ids
+        with self.assertNumQueries(2):
+            users = User.remote.get_by_slugs(['durov', 'id3', 'alexandra', 'unknown'])
+
+        self.assertEqual(method.call_count, 1)
+        self.assertEqual(method.call_args[0][0], 'execute')
+        self.assertEqual([user and user.remote_id for user in users.values()], [1, 3, 2, None])
+        self.assertEqual(users['id3'].pk, User.objects.get(remote_id=3).pk)
+        self.assertEqual(users['id3'].screen_name, 'id3')
+        self.assertEqual(User.objects.count(), 2)
+
+        # resolved names are cached
+        with self.assertNumQueries(1):
+            users = User.remote.get_by_urls(['https://vk.com/durov', 'http://vk.com/alexandra'])
+        self.assertEqual([user.remote_id for user in users.values()], [1, 2])
+        self.assertEqual(method.call_count, 1)
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: {'count': 3, 'items': [
+        {'id': 1, 'screen_name': 'durov'}, {'id': 2, 'screen_name': 'alexandra'}, {'id': 3, 'screen_name': 'ilya'}]})
+    def test_fetch_bulk(self, method):
+
+        User.objects.create(remote_id=1, screen_name='old')
+        receiver = mock.Mock()
+        vkontakte_api_post_fetch_batch.connect(receiver, sender=User)
+
+        # select of existed, insert of new, update of existed, select of result
+        with self.assertNumQueries(4 + 2):  # + savepoint and release
+            users = list(User.remote.fetch(user_ids=[1, 2, 3], bulk=True))
+
+        self.assertEqual(len(users), 3)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(User.objects.get(remote_id=1).screen_name, 'durov')
+        self.assertTrue(User.objects.get(remote_id=2).fetched)
+
+        self.assertEqual(receiver.call_count, 1)
+        self.assertEqual([user.remote_id for user in receiver.call_args[1]['created']], [2, 3])
+        self.assertEqual([user.remote_id for user in receiver.call_args[1]['updated']], [1])
+        vkontakte_api_post_fetch_batch.disconnect(receiver, sender=User)
+
+        # primary keys of created instances are defined for receivers
+        UserID.objects.create(remote_id=1, screen_name='old')
+        vkontakte_api_post_fetch_batch.connect(receiver, sender=UserID)
+        UserID.remote.fetch(user_ids=[1, 2, 3], bulk=True)
+        created = receiver.call_args[1]['created']
+        self.assertEqual([user.pk for user in created],
+                         [UserID.objects.get(remote_id=user.remote_id).pk for user in created])
+        self.assertTrue(all([user.pk for user in created]))
+        self.assertFalse(any([user._state.adding for user in created]))
+        vkontakte_api_post_fetch_batch.disconnect(receiver, sender=UserID)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time', return_value=1000.)
+    def test_rate_limiter(self, time, sleep):
+
+        limiter = TokenBucketRateLimiter(rate=3)
+
+        # burst of 3 calls without waiting for each token
+        self.assertEqual([limiter.acquire('token1') for i in range(3)], [0, 0, 0])
+        self.assertEqual(limiter.acquire('token2'), 0)
+        self.assertFalse(sleep.called)
+
+        self.assertAlmostEqual(limiter.acquire('token1'), 1. / 3)
+        self.assertAlmostEqual(limiter.acquire('token1'), 2. / 3)
+        self.assertEqual(sleep.call_count, 2)
+
+        # bucket refilled in a second
+        time.return_value = 1002.
+        self.assertEqual(limiter.acquire('token1'), 0)
+
+        limiter.penalize('token2')
+        self.assertAlmostEqual(limiter.acquire('token2'), 1. / 3)
+
+        limiter.register_call(0.5, 0.2)
+        self.assertEqual(limiter.stats, {'calls': 1, 'wait_time': 0.5, 'run_time': 0.2})
+
+    @mock.patch('time.time', return_value=1000.)
+    def test_local_cache(self, time):
+
+        cache = LocalCache(maxsize=2, ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # least recently used item evicted
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+        time.return_value = 1011.
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats, {'hits': 2, 'misses': 2, 'hit_rate': 0.5, 'size': 1})
+
+    def test_django_cache(self):
+
+        cache = DjangoCache(prefix='test_django_cache', ttl=10)
+        backend = cache.cache
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+
+        # value and version of keys are read by one request
+        with mock.patch('vkontakte_api.cache.caches', {'default': mock.Mock(wraps=backend)}) as caches:
+            self.assertEqual(cache.get('a'), 1)
+            cache.set('b', 2)
+            self.assertEqual(cache.get('b'), 2)
+        self.assertEqual([call[0] for call in caches['default'].method_calls], ['get_many', 'set', 'get_many'])
+
+        # clearing by other instance, for example in other process
+        DjangoCache(prefix='test_django_cache').clear()
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 3)
+        self.assertEqual(cache.get('a'), 3)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 3, 'hit_rate': 0.5, 'size': 0})
+
+    @mock.patch('vkontakte_api.api.response_cache', LocalCache())
+    @mock.patch('vkontakte_api.api.CACHE_METHODS', {'users.get': 60, 'users.delete': 60})
+    @mock.patch('vkontakte_api.api.VkontakteApi.call', side_effect=lambda method, **kw: [{'id': 1}])
+    def test_api_call_cache(self, call):
+
+        response = api_call('users.get', user_ids=[1, 2], fields='sex', v=5.0)
+        response[0]['id'] = 2
+        self.assertEqual(api_call('users.get', v=5.0, fields='sex', user_ids=[1, 2]), [{'id': 1}])
+        self.assertEqual(call.call_count, 1)
+
+        # other params, not cached and write methods
+        api_call('users.get', user_ids=[2, 1], v=5.0)
+        api_call('users.search', q='name')
+        api_call('users.delete', user_id=1)
+        api_call('users.delete', user_id=1)
+        self.assertEqual(call.call_count, 5)
+
+        # responses for token of call context are cached separately
+        with override_api_context('vkontakte', token='token1'):
+            api_call('users.get', user_ids=[1, 2], fields='sex', v=5.0)
+            api_call('users.get', user_ids=[1, 2], fields='sex', v=5.0)
+        with override_api_context('vkontakte', token='token2'):
+            api_call('users.get', user_ids=[1, 2], fields='sex', v=5.0)
+        self.assertEqual(call.call_count, 7)
+
+    @mock.patch('time.time', return_value=1000.)
+    def test_access_token_pool(self, time):
+
+        pool = AccessTokenPool(rate=3, daily_limit=100)
+        tokens = ['token1', 'token2', 'token3']
+
+        for i in range(3):
+            pool.register_call('token1')
+        pool.register_call('token2')
+        self.assertEqual(pool.choose(tokens), 'token3')
+
+        pool.cooldown('token3', 600)
+        self.assertEqual(pool.choose(tokens), 'token2')
+
+        # daily usage is more important, than recent rate
+        time.return_value = 1100.
+        for i in range(50):
+            pool.register_call('token2')
+        time.return_value = 1200.
+        self.assertEqual(pool.choose(tokens), 'token1')
+
+        pool.cooldown('token1', 60)
+        pool.cooldown('token2', 120)
+        pool.cooldown('token3', 180)
+        self.assertEqual(pool.choose(tokens), None)
+
+        # cooldown expired
+        time.return_value = 1280.
+        self.assertEqual(pool.choose(tokens), 'token1')
+
+        pool.cooldown('token1', 60)
+        self.assertTrue(pool.release_earliest(tokens))
+        self.assertEqual(pool.choose(tokens), 'token2')
+
+    @mock.patch('vkontakte_api.models.VkontakteManager.api_call', return_value=1)
+    def test_save_changed_fields(self, api_call):
+        Note.objects.create(remote_id=1, title='title', text='text', fetched=timezone.now(), commit_remote=False)
+
+        note = Note.objects.get(remote_id=1)
+        self.assertFalse(note.fields_changed)
+        note.text = 'new text'
+        self.assertEqual(note.get_changed_fields(), ['text'])
+        self.assertTrue(note.fields_changed)
+
+        # remote object and the only changed field are updated without reading of instance from DB
+        with self.assertNumQueries(3) as context:
+            note.save()
+        self.assertEqual(api_call.call_args[1], {'method': 'update', 'note_id': 1, 'text': 'new text'})
+        self.assertNotIn('"title"', context.captured_queries[1]['sql'])
+        self.assertFalse(note.fields_changed)
+        self.assertEqual(Note.objects.get(remote_id=1).text, 'new text')
+
+        # instance, that was not loaded, reads values from DB once
+        note = Note(pk=note.pk, remote_id=1, title='new title', text='new text', fetched=note.fetched)
+        with self.assertNumQueries(4):
+            note.save()
+        self.assertEqual(api_call.call_args[1], {'method': 'update', 'note_id': 1, 'title': 'new title'})
+
+        # instance, loaded without snapshot of values (Django 1.7 doesn't call from_db), reads values from DB once
+        note = Note.objects.get(remote_id=1)
+        note._loaded_values = None
+        note.text = 'text'
+        self.assertEqual(note.get_changed_fields(), ['text'])
+
+        # fields, changed by receivers of pre_save, are saved too
+        def pre_save(instance, **kwargs):
+            instance.title = 'title from receiver'
+        models.signals.pre_save.connect(pre_save, sender=Note)
+        note = Note.objects.get(remote_id=1)
+        note.text = 'text'
+        with self.assertNumQueries(3) as context:
+            note.save(commit_remote=False)
+        models.signals.pre_save.disconnect(pre_save, sender=Note)
+        self.assertEqual(Note.objects.get(remote_id=1).title, 'title from receiver')
+        self.assertIn('"title"', context.captured_queries[1]['sql'])
+        if django.VERSION >= (1, 8):
+            # Django 1.7 doesn't call from_db(), instance without snapshot of values is saved entirely
+            self.assertNotIn('"remote_id"', context.captured_queries[1]['sql'])
+
+        # unchanged instance is not updated
+        with self.assertNumQueries(2):
+            note.save(commit_remote=False)
+
+        # instance, substituted by manager, compares values with old instance without reading from DB again
+        note = Note(remote_id=1, title='title from receiver', text='fetched text', fetched=note.fetched)
+        with self.assertNumQueries(4) as context:
+            Note.remote.get_or_create_from_instance(note)
+        self.assertEqual(api_call.call_args[1], {'method': 'update', 'note_id': 1, 'text': 'fetched text'})
+        self.assertNotIn('"title"', context.captured_queries[2]['sql'])
+        self.assertEqual(Note.objects.get(remote_id=1).text, 'fetched text')
+
+    @mock.patch('vkontakte_api.models.NATIVE_UPSERT', True)
+    def test_save_upsert(self):
+
+        user = UserID.objects.create(remote_id=1, screen_name='111')
+        receiver = mock.Mock()
+        models.signals.post_save.connect(receiver, sender=UserID)
+
+        # upsert with returning of primary keys: one statement on PostgreSQL, insertion and updating on SQLite 3.35+,
+        # otherwise select of existed, upsert, select of primary keys. Without savepoints
+        if connection.vendor == 'postgresql':
+            queries_insert = queries_update = 1
+        elif connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35):
+            queries_insert, queries_update = 1, 2
+        else:
+            queries_insert = queries_update = 3
+
+        with self.assertNumQueries(queries_update):
+            UserID(remote_id=1, screen_name='222').save()
+            self.assertFalse(receiver.call_args[1]['created'])
+
+        with self.assertNumQueries(queries_insert):
+            UserID(remote_id=2, screen_name='333').save()
+            self.assertTrue(receiver.call_args[1]['created'])
+        self.assertEqual(UserID.objects.get(remote_id=1).pk, user.pk)
+        self.assertEqual(UserID.objects.get(remote_id=1).screen_name, '222')
+        self.assertEqual(UserID.objects.count(), 2)
+        models.signals.post_save.disconnect(receiver, sender=UserID)
+
+        # existed rows of list are updated by one statement
+        users = UserID.remote.get_or_create_from_instances([UserID(remote_id=1, screen_name='444'),
+                                                            UserID(remote_id=2, screen_name='555'),
+                                                            UserID(remote_id=3, screen_name='666')])
+        self.assertEqual(sorted(users.values_list('screen_name', flat=True)), ['444', '555', '666'])
+        self.assertEqual(UserID.objects.get(remote_id=1).pk, user.pk)
+
+    def test_update_add_only_fields(self):
+
+        created = Post.objects.create(remote_id=1, text='a').created
+        self.assertIsNotNone(created)
+
+        # value of field with auto_now_add is kept while updating by upsert and without it
+        for native_upsert in [True, False]:
+            with mock.patch('vkontakte_api.models.NATIVE_UPSERT', native_upsert):
+                Post.remote.get_or_create_from_instances([Post(remote_id=1, text=str(native_upsert)),
+                                                          Post(remote_id=2, text='b')])
+            self.assertEqual(Post.objects.get(remote_id=1).text, str(native_upsert))
+            self.assertEqual(Post.objects.get(remote_id=1).created, created)
+
+        with mock.patch('vkontakte_api.models.NATIVE_UPSERT', True):
+            Post(remote_id=1, text='c').save()
+        self.assertEqual(Post.objects.get(remote_id=1).text, 'c')
+        self.assertEqual(Post.objects.get(remote_id=1).created, created)
+
+    def test_upsert_supported(self):
+
+        with mock.patch('vkontakte_api.upsert.connections', {'default': mock.Mock(vendor='postgresql')}) as c:
+            c['default'].pg_version = 90400
+            self.assertFalse(is_upsert_supported(Post))
+            c['default'].pg_version = 90500
+            self.assertTrue(is_upsert_supported(Post))
+
+        # ON DUPLICATE KEY UPDATE of MySQL is fired by unique field screen_name too
+        with mock.patch('vkontakte_api.upsert.connections', {'default': mock.Mock(vendor='mysql')}):
+            self.assertTrue(is_upsert_supported(Post))
+            self.assertFalse(is_upsert_supported(UserID))
+
     def test_save_user_integrity_error(self):
 
         user = UserID.objects.create(remote_id=1, screen_name='111')
@@ -91,6 +850,216 @@ class VkontakteApiTest(VkontakteApiTestCase):
         except IntegrityError:
             pass
 
+    def test_api_call_connections_pool(self):
+
+        StandInApiRequestHandler.requests = []
+        StandInApiRequestHandler.responses = [{'response': {'object_id': 1, 'type': 'user'}}] * 3
+        stats = get_pool_stats()
+
+        with StandInApiServer() as server, mock.patch.object(SessionAPI, 'url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            for i in range(3):
+                response = api_call('resolveScreenName', screen_name='durov')
+
+        self.assertEqual(response, {'object_id': 1, 'type': 'user'})
+        self.assertEqual(StandInApiRequestHandler.requests[0][0], '/method/resolveScreenName')
+
+        # the only connection is opened for all requests
+        stats_new = get_pool_stats()
+        self.assertEqual(stats_new['requests'] - stats['requests'], 3)
+        self.assertEqual(stats_new['opened'] - stats['opened'], 1)
+        self.assertEqual(stats_new['reused'] - stats['reused'], 2)
+
+    def test_api_call_cookies(self):
+
+        StandInApiRequestHandler.cookies = []
+        StandInApiRequestHandler.responses = [{'response': {'object_id': 1, 'type': 'user'}}] * 2
+
+        with StandInApiServer() as server, mock.patch.object(SessionAPI, 'url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            api_call('resolveScreenName', screen_name='durov')
+            api_call('resolveScreenName', screen_name='durov')
+
+        # cookies of responses are not sent with the next requests of shared session
+        self.assertEqual(StandInApiRequestHandler.cookies, [None, None])
+        self.assertEqual(len(get_session().cookies), 0)
+
+    def test_streamed_response(self):
+
+        def stream(response):
+            return streaming.StreamedResponse(BytesIO(json.dumps(response).encode('utf8')))
+
+        # decoding by ijson if installed and by json
+        for ijson in set([streaming.ijson, None]):
+            with mock.patch.object(streaming, 'ijson', ijson):
+                response = stream({'response': {'count': 10, 'items': [{'id': 1, 'rating': 2.5}, {'id': 2}]}})
+                self.assertEqual(list(response), [{'id': 1, 'rating': 2.5}, {'id': 2}])
+                self.assertEqual(response.total_count, 10)
+
+                response = stream({'response': [{'id': 1, 'counters': {'photos': 1}}, [{'id': 2}], False]})
+                self.assertEqual(list(response), [{'id': 1, 'counters': {'photos': 1}}, [{'id': 2}], False])
+
+                self.assertEqual(list(stream({'response': {'object_id': 1, 'type': 'user'}})),
+                                 [{'object_id': 1, 'type': 'user'}])
+
+                with self.assertRaises(VkontakteError) as context:
+                    stream({'error': {'error_code': 15, 'error_msg': 'Access denied', 'request_params': []}})
+                self.assertEqual(context.exception.code, 15)
+
+                # body is closed after reading, on stopping of reading and on error
+                error = {'error_code': 15, 'error_msg': 'Access denied', 'request_params': []}
+                for response in [{'response': [1, 2, 3]}, {'error': error}]:
+                    body = BytesIO(json.dumps(response).encode('utf8'))
+                    try:
+                        for resource in streaming.StreamedResponse(body):
+                            self.assertFalse(body.closed)
+                            break
+                    except VkontakteError:
+                        pass
+                    self.assertTrue(body.closed)
+
+    def test_fetch_stream(self):
+
+        StandInApiRequestHandler.requests = []
+        StandInApiRequestHandler.responses = [
+            {'response': {'count': 2, 'items': [{'id': 1, 'screen_name': 'durov'}, {'id': 2, 'screen_name': 'a'}]}},
+            {'response': [{'count': 1, 'items': [{'id': 3, 'screen_name': 'ilya'}]}, {'object_id': 1, 'type': 'user'}]},
+        ]
+
+        with StandInApiServer() as server, mock.patch.object(SessionAPI, 'url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            users = User.remote.fetch(user_ids=[1, 2], stream=True)
+            with batch(stream=True) as b:
+                users_batch = b.get(User.remote, user_ids=[3])
+                resolved = b.add('resolveScreenName', screen_name='durov')
+
+        self.assertEqual(users.total_count, 2)
+        self.assertEqual([user.screen_name for user in users], ['durov', 'a'])
+        self.assertEqual(users_batch.result[0].screen_name, 'ilya')
+        self.assertEqual(resolved.result, {'object_id': 1, 'type': 'user'})
+
+    def test_batch_execute_errors(self):
+
+        error = {'method': 'resolveScreenName', 'error_code': 15, 'error_msg': 'Access denied'}
+        StandInApiRequestHandler.requests = []
+        # errors follow the response of API, streamed response reads them from the rest of body
+        StandInApiRequestHandler.responses = [
+            OrderedDict([('response', [False, 1400000000]), ('execute_errors', [error])]),
+            OrderedDict([('response', [False, 1400000000]), ('execute_errors', [error])]),
+        ]
+
+        with StandInApiServer() as server, mock.patch.object(SessionAPI, 'url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            for stream in [False, True]:
+                with batch(stream=stream) as b:
+                    resolved = b.add('resolveScreenName', screen_name='unknown')
+                    time = b.add('utils.getServerTime')
+
+                self.assertEqual(resolved.error.code, 15)
+                self.assertEqual(resolved.error.params, {'screen_name': 'unknown'})
+                self.assertEqual(time.result, 1400000000)
+
+        self.assertEqual(len(StandInApiRequestHandler.requests), 2)
+
+    @override_settings(USE_TZ=True)
+    def test_fetch_stream_connections(self):
+
+        def response(count, text=''):
+            items = [{'id': i, 'date': 1400000000 + i, 'text': text} for i in range(count, 0, -1)]
+            return {'response': {'count': count, 'items': items}}
+
+        StandInApiRequestHandler.requests = []
+        # body of the second response is longer, than buffer of decoder
+        StandInApiRequestHandler.responses = [response(3), response(2000, 'x' * 100), response(3)]
+        after = datetime.utcfromtimestamp(1400000000 + 2000).replace(tzinfo=timezone.utc)
+
+        with StandInApiServer() as server, mock.patch.object(SessionAPI, 'url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            # connection of entirely read response is reused
+            self.assertEqual(Post.remote.fetch(owner_id=1, stream=True).count(), 3)
+            # reading of response is stopped on the first post before `after`
+            self.assertEqual(Post.remote.fetch(owner_id=1, stream=True, after=after).count(), 1)
+            self.assertEqual(Post.remote.fetch(owner_id=1, stream=True).count(), 3)
+
+        # connection with not read rest of incrementally decoded body is closed, body decoded by json is read entirely
+        clients = StandInApiRequestHandler.clients[-3:]
+        self.assertEqual(clients[0], clients[1])
+        self.assertEqual(clients[1] != clients[2], bool(streaming.ijson))
+
+    @override_settings(USE_TZ=True)
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: {'count': 1000, 'items': [
+        {'id': i, 'date': 1400000000 + i, 'text': 'post %d' % i} for i in range(1000, 0, -1)]})
+    def test_fetch_timeline_queryset(self, method):
+
+        posts = Post.remote.fetch(owner_id=1)
+        sql = str(posts.query)
+
+        # the only condition with list of primary keys instead of condition for each post
+        self.assertEqual(sql.count(' IN ('), 1)
+        self.assertEqual(sql.count(' OR '), 0)
+        self.assertEqual(posts.count(), 1000)
+        self.assertEqual(posts.total_count, 1000)
+
+        after = datetime.utcfromtimestamp(1400000000 + 901).replace(tzinfo=timezone.utc)
+        before = datetime.utcfromtimestamp(1400000000 + 950).replace(tzinfo=timezone.utc)
+        posts = Post.remote.fetch(owner_id=1, after=after, before=before)
+        self.assertEqual(sorted(posts.values_list('remote_id', flat=True)), list(range(901, 951)))
+
+    @override_settings(USE_TZ=True)
+    @mock.patch('vkontakte_api.models.api_call')
+    def test_fetch_timeline_incremental(self, method):
+
+        def response(ids, count):
+            return {'count': count, 'items': [{'id': i, 'date': 1400000000 + i} for i in ids]}
+
+        # the first page of long timeline makes pending state
+        method.return_value = response(range(10, 5, -1), 10)
+        self.assertEqual(Post.remote.fetch(owner_id=1, count=5, incremental=True).count(), 5)
+        state = VkontakteSyncState.objects.get(model='vkontakte_api.Post', owner='1', method='get')
+        self.assertEqual(state.cut, None)
+        self.assertEqual(state.pending_head_ids, '10,9,8,7,6')
+
+        # the last page makes actual state
+        method.return_value = response(range(5, 0, -1), 10)
+        self.assertEqual(Post.remote.fetch(owner_id=1, count=5, offset=5, incremental=True).count(), 5)
+        state = VkontakteSyncState.objects.get()
+        self.assertEqual(state.cut, datetime.utcfromtimestamp(1400000010).replace(tzinfo=timezone.utc))
+        self.assertEqual(state.head_ids, '10,9,8,7,6')
+
+        # only new items are saved until known ones
+        method.return_value = response([12, 11, 10, 9, 8], 12)
+        posts = Post.remote.fetch(owner_id=1, count=5, incremental=True)
+        self.assertEqual(sorted(posts.values_list('remote_id', flat=True)), [11, 12])
+        state = VkontakteSyncState.objects.get()
+        self.assertEqual(state.cut, datetime.utcfromtimestamp(1400000012).replace(tzinfo=timezone.utc))
+        self.assertEqual(state.head_ids, '12,11,10,9,8')
+
+    @override_settings(USE_TZ=True)
+    @mock.patch('vkontakte_api.models.api_call')
+    def test_fetch_timeline_seek(self, method):
+
+        # timeline of 1000 posts from new to old, one post per day
+        def response(*args, **kwargs):
+            offset, count = kwargs.get('offset', 0), kwargs.get('count', 100)
+            return {'count': 1000, 'items': [{'id': 1000 - i, 'date': 1400000000 + (1000 - i) * 86400}
+                                             for i in range(offset, min(offset + count, 1000))]}
+        method.side_effect = response
+
+        def date(remote_id):
+            return datetime.utcfromtimestamp(1400000000 + remote_id * 86400).replace(tzinfo=timezone.utc)
+
+        self.assertEqual(Post.remote.seek_offset(date(300), owner_id=1), 700)
+        self.assertEqual(Post.remote.seek_offset(date(300) - timedelta(hours=1), owner_id=1), 701)
+        self.assertEqual(Post.remote.seek_offset(date(2000), owner_id=1), 0)
+        self.assertEqual(Post.remote.seek_offset(date(0), owner_id=1), 1000)
+        method.reset_mock()
+
+        posts = Post.remote.fetch(owner_id=1, count=10, after=date(295), before=date(300), seek=True)
+        self.assertEqual(posts.offset, 700)
+        self.assertEqual(sorted(posts.values_list('remote_id', flat=True)), [295, 296, 297, 298, 299, 300])
+        # probes of binary search and the page
+        self.assertLessEqual(method.call_count, 12)
+
     def test_parse_page(self):
 
         parser = VkontakteParser()
@@ -134,3 +1103,221 @@ class VkontakteApiTest(VkontakteApiTestCase):
         for count, total in instance.some_method(10, as_generator=True):
             self.assertEqual((count, total), (i, 10))
             i += 1
+
+    def test_memoize_decorator(self):
+
+        calls = []
+
+        @memoize(maxsize=2)
+        def square(value):
+            calls.append(value)
+            return value ** 2
+
+        self.assertEqual([square(1), square(2), square(1), square(3)], [1, 4, 1, 9])
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual(square.cache.stats['size'], 2)
+
+        # least recently used value evicted
+        square(2)
+        square.invalidate(1)
+        square(1)
+        self.assertEqual(calls, [1, 2, 3, 2, 1])
+        self.assertEqual(square.cache.stats['hits'], 1)
+
+        square.clear()
+        self.assertEqual(square.cache.stats['size'], 0)
+
+    def test_fetch_all_decorator(self):
+
+        class FetchAllMethodClass(object):
+
+            # 3000 pages is deeper, than default recursion limit
+            calls = 0
+
+            @fetch_all(default_count=2, max_extra_calls=3)
+            def fetch_something(self, total=6000, count=2, offset=0):
+                self.calls += 1
+                if offset >= total:
+                    return []
+                return list(range(offset, min(offset + count, total)))
+
+        instance = FetchAllMethodClass()
+        self.assertEqual(instance.fetch_something(), [0, 1])
+        self.assertEqual(instance.fetch_something(all=True), list(range(6000)))
+
+        # 3 pages and 2 extra calls after incomplete page
+        instance.calls = 0
+        self.assertEqual(instance.fetch_something(all=True, total=5), [0, 1, 2, 3, 4])
+        self.assertEqual(instance.calls, 5)
+
+        items = instance.fetch_something(all=True, as_generator=True)
+        self.assertFalse(isinstance(items, list))
+        self.assertEqual(next(items), 0)
+        self.assertEqual(list(items), list(range(1, 6000)))
+
+    def test_fetch_all_decorator_concurrency(self):
+
+        class FetchAllMethodClass(object):
+
+            threads = set()
+
+            @fetch_all(default_count=10, concurrency=4)
+            def fetch_something(self, count=10, offset=0):
+                self.threads.add(threading.current_thread().name)
+                return VkontakteResponseList(range(offset, min(offset + count, 95)), total_count=95)
+
+        instance = FetchAllMethodClass()
+        self.assertEqual(instance.fetch_something(all=True), list(range(95)))
+        self.assertTrue(len(instance.threads) > 1)
+
+        instance.threads.clear()
+        self.assertEqual(list(instance.fetch_something(all=True, concurrency=1, as_generator=True)), list(range(95)))
+        self.assertEqual(instance.threads, set([threading.current_thread().name]))
+
+    def test_fetch_all_decorator_concurrency_cutoff(self):
+
+        class FetchAllMethodClass(object):
+
+            offsets = []
+
+            @fetch_all(default_count=10, concurrency=4)
+            def fetch_something(self, count=10, offset=0, after=None):
+                # items older than `after` are cut off, like in timelines
+                self.offsets.append(offset)
+                items = [i for i in range(offset, min(offset + count, 1000)) if after is None or i < after]
+                return VkontakteResponseList(items, total_count=1000)
+
+        instance = FetchAllMethodClass()
+        self.assertEqual(instance.fetch_something(all=True, after=25), list(range(25)))
+        # the first page and one wave of pages in parallel, not all pages until total_count
+        self.assertEqual(sorted(instance.offsets), [0, 10, 20, 30, 40])
+
+        del instance.offsets[:]
+        self.assertEqual(instance.fetch_something(all=True, after=10), list(range(10)))
+        self.assertEqual(sorted(instance.offsets), [0, 10, 20, 30, 40])
+
+        del instance.offsets[:]
+        self.assertEqual(instance.fetch_something(all=True, concurrency=1, after=10), list(range(10)))
+        self.assertEqual(instance.offsets, [0, 10])
+
+    @mock.patch('vkontakte_api.models.api_call')
+    def test_fetch_all_concurrency_transaction(self, method):
+        threads = set()
+
+        def response(method, count, offset, **kwargs):
+            threads.add(threading.current_thread().name)
+            items = [{'id': i, 'screen_name': 'u%d' % i} for i in range(offset, min(offset + count, 7))]
+            return {'count': 7, 'items': items}
+        method.side_effect = response
+
+        # API calls are made in threads, objects are saved in transaction of the calling thread
+        try:
+            with transaction.atomic():
+                users = UserID.remote.fetch_search(all=True)
+                self.assertEqual(sorted(users.values_list('remote_id', flat=True)), list(range(7)))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(UserID.objects.count(), 0)
+        self.assertEqual(method.call_count, 4)
+        self.assertTrue(len(threads) > 1)
+
+    @mock.patch('vkontakte_api.models.api_call')
+    def test_fetch_all_return_all(self, method):
+        method.side_effect = lambda method, count, offset, **kwargs: {
+            'count': 5, 'items': [{'id': i, 'screen_name': 'u%d' % i} for i in range(offset, min(offset + count, 5))]}
+
+        users = UserID.remote.fetch_search(all=True, concurrency=1)
+        self.assertEqual(sorted(users.values_list('remote_id', flat=True)), list(range(5)))
+
+        # primary keys of pages are not selected, if result is defined by `return_all`
+        with mock.patch('vkontakte_api.decorators.QuerySet.values_list') as values_list:
+            users = UserID.remote.fetch_search_all(all=True)
+            self.assertFalse(values_list.called)
+        self.assertEqual(users.count(), 5)
+
+    def test_parse_response_total_count(self):
+
+        users = User.remote.parse_response({'count': 100, 'items': [{'id': 1, 'screen_name': 'durov'}]})
+        self.assertEqual(users.total_count, 100)
+        self.assertEqual(users[0].remote_id, 1)
+
+    def test_parse_fields(self):
+
+        user = UserID()
+        user.parse({'id': '1', 'screen_name': 12, 'followers_count': '-5', 'last_seen': 1400000000,
+                    'langs': [1, 2], 'unknown': 1})
+
+        self.assertEqual(user.remote_id, 1)
+        self.assertEqual(user.screen_name, '12')
+        self.assertEqual(user.followers_count, 0)
+        self.assertEqual(user.last_seen, datetime(2014, 5, 13, 16, 53, 20, tzinfo=timezone.utc))
+        self.assertEqual(user.langs, '1,2')
+        self.assertEqual(set(UserID.get_parse_plan()), set(['id', 'screen_name', 'followers_count', 'last_seen',
+                                                            'langs', 'unknown']))
+
+    @mock.patch('vkontakte_api.models.api_call', side_effect=lambda *a, **kw: {'count': 2, 'items': [
+        {'id': 1, 'screen_name': 'durov', 'last_seen': 1400000000}, {'id': 2, 'followers_count': '10'}]})
+    def test_get_as_records(self, method):
+
+        with self.assertNumQueries(0):
+            records = UserID.remote.get(user_ids=[1, 2], as_records=True)
+
+        self.assertEqual(records.total_count, 2)
+        self.assertEqual([record.remote_id for record in records], [1, 2])
+        self.assertEqual(records[0].screen_name, 'durov')
+        self.assertEqual(records[0].last_seen, datetime(2014, 5, 13, 16, 53, 20, tzinfo=timezone.utc))
+        self.assertEqual(records[1].screen_name, None)
+        self.assertEqual(records[1].followers_count, 10)
+        self.assertTrue(records[1].fetched)
+        self.assertFalse(hasattr(records[1], '__dict__'))
+
+    def test_parse_response_prepare_resources(self):
+
+        with mock.patch.object(User, 'prepare_resources') as prepare_resources:
+            users = User.remote.parse_response([{'id': 1}, {'id': 2}])
+
+        # all resources are prepared before parsing
+        prepare_resources.assert_called_once_with([{'id': 1}, {'id': 2}])
+        self.assertEqual(len(users), 2)
+
+    @unittest.skipIf(IOLoop is None, "asynchronous client requires tornado")
+    def test_async_get(self):
+
+        StandInApiRequestHandler.requests = []
+        StandInApiRequestHandler.responses = [
+            {'error': {'error_code': 6, 'error_msg': 'Too many requests per second', 'request_params': []}},
+            {'response': {'count': 1, 'items': [{'id': 1, 'screen_name': 'durov'}]}},
+        ]
+        with StandInApiServer() as server, mock.patch.object(AsyncVkontakteApi, 'api_url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            users = IOLoop.current().run_sync(lambda: User.remote.aget(user_ids=[1]))
+
+        # error 6 is handled by repeating of the call
+        self.assertEqual(len(StandInApiRequestHandler.requests), 2)
+        self.assertEqual(StandInApiRequestHandler.requests[1][0], '/method/users.get')
+        self.assertIn(b'user_ids=1', StandInApiRequestHandler.requests[1][1])
+        self.assertEqual(users.total_count, 1)
+        self.assertEqual(users[0].remote_id, 1)
+
+    @unittest.skipIf(IOLoop is None, "asynchronous client requires tornado")
+    def test_async_api_call(self):
+
+        StandInApiRequestHandler.requests = []
+        StandInApiRequestHandler.responses = [
+            {'response': 1400000000},
+            {'response': 1400000000},
+            {'error': {'error_code': 100, 'error_msg': 'One of the parameters specified was missing or invalid',
+                       'request_params': []}},
+        ]
+        with StandInApiServer() as server, mock.patch.object(AsyncVkontakteApi, 'api_url', server.url), \
+                override_api_context('vkontakte', token=TOKEN):
+            # calls are made concurrently in one thread
+            responses = IOLoop.current().run_sync(lambda: gen.multi([
+                async_api_call('utils.getServerTime'), async_api_call('utils.getServerTime')]))
+            self.assertEqual(responses, [1400000000, 1400000000])
+
+            # error without handler is raised
+            with self.assertRaises(VkontakteError) as context:
+                IOLoop.current().run_sync(lambda: async_api_call('users.get', user_ids=[0]))
+            self.assertEqual(context.exception.code, 100)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Native upsert of rows by unique field `remote_id`: INSERT ... ON CONFLICT DO UPDATE on PostgreSQL 9.5+ and SQLite 3.24+,
+INSERT ... ON DUPLICATE KEY UPDATE on MySQL for models with the only unique field.
+Primary keys are returned by the same statements on PostgreSQL and SQLite 3.35+ with RETURNING
+"""
+from collections import OrderedDict
+import sqlite3
+
+from django.db import connections, models
+from django.db.models.fields import FieldDoesNotExist
+
+__all__ = ['upsert', 'is_upsert_supported', 'get_update_fields']
+
+
+def get_update_fields(model):
+    """
+    Return fields of model for updating of existed rows, without primary key and fields, defined only on adding
+    """
+    return [f for f in model._meta.concrete_fields if not f.primary_key and not getattr(f, 'auto_now_add', False)]
+
+
+def is_upsert_supported(model, using='default', field_name='remote_id'):
+    connection = connections[using]
+    try:
+        field = model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return False
+
+    if not (field.unique or field.primary_key):
+        return False
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24)
+    elif connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    elif connection.vendor == 'mysql':
+        # ON DUPLICATE KEY UPDATE is fired by any unique key, so the field should be the only one
+        unique = [f for f in model._meta.concrete_fields if f.unique and not isinstance(f, models.AutoField)]
+        return unique == [field] and not model._meta.unique_together
+    return False
+
+
+def upsert(model, instances, using='default', field_name='remote_id'):
+    """
+    Insert rows of instances or update existed rows with the same value of unique field by one statement.
+    Primary keys of instances are defined after upsert, methods save() and signals are not called.
+    Return list of flags of creation of rows
+    """
+    connection = connections[using]
+    # the last one of instances with the same value of field wins, otherwise PostgreSQL raises error
+    instances = OrderedDict([(getattr(instance, field_name), instance) for instance in instances]).values()
+    if not instances:
+        return []
+
+    pk = model._meta.pk
+    field = model._meta.get_field(field_name)
+    fields = [f for f in model._meta.concrete_fields if not isinstance(f, models.AutoField)]
+    fields_update = [f for f in get_update_fields(model) if f != field]
+    values = [field.to_python(getattr(instance, field_name)) for instance in instances]
+    params = dict([(value, [f.get_db_prep_save(f.pre_save(instance, True), connection=connection) for f in fields])
+                   for value, instance in zip(values, instances)])
+
+    quote = connection.ops.quote_name
+
+    def get_insert(values):
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            quote(model._meta.db_table),
+            ', '.join([quote(f.column) for f in fields]),
+            ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(values)))
+        return sql, sum([params[value] for value in values], [])
+
+    sql, sql_params = get_insert(values)
+    conflict = ' ON CONFLICT (%s)' % quote(field.column)
+    update = ' DO UPDATE SET %s' % ', '.join(
+        ['%s = excluded.%s' % (quote(f.column), quote(f.column)) for f in fields_update or [field]])
+    returning = ' RETURNING %s, %s' % (quote(field.column), quote(pk.column))
+
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        # xmax of inserted row is 0
+        cursor.execute(sql + conflict + update + returning + ', (xmax = 0)', sql_params)
+        rows = dict([(value, (pk_value, created)) for value, pk_value, created in cursor.fetchall()])
+    elif connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35):
+        # new rows are inserted and returned by the first statement, existed rows are updated by the second one
+        cursor.execute(sql + conflict + ' DO NOTHING' + returning, sql_params)
+        rows = dict([(value, (pk_value, True)) for value, pk_value in cursor.fetchall()])
+        existed = [value for value in values if value not in rows]
+        if existed:
+            sql, sql_params = get_insert(existed)
+            cursor.execute(sql + conflict + update + returning, sql_params)
+            rows.update([(value, (pk_value, False)) for value, pk_value in cursor.fetchall()])
+    else:
+        if connection.vendor == 'mysql':
+            sql += ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+                ['%s = LAST_INSERT_ID(%s)' % (quote(pk.column), quote(pk.column))] +
+                ['%s = VALUES(%s)' % (quote(f.column), quote(f.column)) for f in fields_update])
+        else:
+            sql += conflict + update
+
+        if connection.vendor == 'mysql' and len(instances) == 1:
+            # number of affected rows is 1 for inserted row and 2 for updated, id is returned for both of them
+            cursor.execute(sql, sql_params)
+            rows = {values[0]: (cursor.lastrowid, cursor.rowcount == 1)}
+        else:
+            # existed rows are selected before, because MySQL and old SQLite don't report inserted rows
+            queryset = model._base_manager.using(using).filter(**{'%s__in' % field_name: values})
+            existed = set(queryset.values_list(field_name, flat=True))
+            cursor.execute(sql, sql_params)
+            rows = dict([(value, (pk_value, value not in existed))
+                         for value, pk_value in queryset.values_list(field_name, 'pk')])
+
+    created = []
+    for value, instance in zip(values, instances):
+        pk_value, instance_created = rows[value]
+        setattr(instance, pk.attname, pk_value)
+        instance._state.adding = False
+        instance._state.db = using
+        created += [bool(instance_created)]
+    return created
@@ -1,4 +1,13 @@
+from array import array
+from multiprocessing.pool import ThreadPool
+import threading
+
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Q
+from django.utils import six
+from django.utils.functional import wraps
+from django.utils.six.moves import zip
 
 
 def get_improperly_configured_field(app_name, decorate_property=False):
@@ -7,3 +16,128 @@ def get_improperly_configured_field(app_name, decorate_property=False):
     if decorate_property:
         field = property(field)
     return field
+
+
+def close_connections(func):
+    """
+    Decorator for functions, called in separate threads. Closes DB connections of the thread after call
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for connection in connections.all():
+                connection.close()
+    return wrapper
+
+
+def run_in_threads(func, items, concurrency):
+    """
+    Generator of results of `func` for each of `items`, called in pool of `concurrency` threads.
+    Results are yielded in order of items
+    """
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        for result in pool.imap(close_connections(func), items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class PrefetchedResponse(Exception):
+    """
+    Interrupts function, running in thread by run_prefetched_in_threads(), after the first API call
+    """
+    def __init__(self, response):
+        self.response = response
+
+
+# state of API calls of functions, running by run_prefetched_in_threads() in the current thread
+prefetch = threading.local()
+
+
+def prefetched_call(call):
+    """
+    Make API call by `call()`. In threads of run_prefetched_in_threads() the first call interrupts function,
+    in the calling thread response of it is returned without the call
+    """
+    if getattr(prefetch, 'interrupt', False):
+        raise PrefetchedResponse(call())
+    elif getattr(prefetch, 'responses', None):
+        return prefetch.responses.pop(0)
+    return call()
+
+
+def run_prefetched_in_threads(func, items, concurrency):
+    """
+    Generator of results of `func` for each of `items` like run_in_threads(), but only the first API call
+    of `func` (made by prefetched_call()) is made in threads, then `func` is called again in the calling thread
+    with response of this call. So objects are parsed and saved to DB in transaction of the calling thread.
+    Functions without API calls are called entirely in threads
+    """
+    def call(item):
+        prefetch.interrupt = True
+        try:
+            return False, func(item)
+        except PrefetchedResponse as e:
+            return True, e.response
+        except Exception:
+            # the call will be repeated in the calling thread with raising of the error
+            return True, None
+        finally:
+            prefetch.interrupt = False
+
+    for item, (prefetched, result) in zip(items, run_in_threads(call, items, concurrency)):
+        if prefetched:
+            prefetch.responses = [result] if result is not None else []
+            try:
+                result = func(item)
+            finally:
+                prefetch.responses = []
+        yield result
+
+
+def get_pks_lookup(pks, chunk=1000):
+    """
+    Return Q object for selecting objects by long list of primary keys. Sequences of consecutive integer keys
+    are selected by ranges, other keys by lists of `chunk` keys
+    """
+    pks = sorted(set(pks))
+    lookup = Q(pk__in=[])
+    if pks and all([isinstance(pk, six.integer_types) for pk in pks]):
+        singles, start = [], 0
+        for i in range(1, len(pks) + 1):
+            if i == len(pks) or pks[i] != pks[i - 1] + 1:
+                if i - start > 2:
+                    lookup |= Q(pk__range=(pks[start], pks[i - 1]))
+                else:
+                    singles += pks[start:i]
+                start = i
+        pks = singles
+
+    for i in range(0, len(pks), chunk):
+        lookup |= Q(pk__in=pks[i:i + chunk])
+    return lookup
+
+
+def diff_sorted_ids(old_ids, new_ids):
+    """
+    Return tuple of arrays of added and removed integer ids, comparing sorted arrays of old and new ids
+    """
+    old_ids, new_ids = array('l', sorted(set(old_ids))), array('l', sorted(set(new_ids)))
+    added, removed = array('l'), array('l')
+    i = j = 0
+    while i < len(old_ids) and j < len(new_ids):
+        if old_ids[i] == new_ids[j]:
+            i += 1
+            j += 1
+        elif old_ids[i] < new_ids[j]:
+            removed.append(old_ids[i])
+            i += 1
+        else:
+            added.append(new_ids[j])
+            j += 1
+    removed.extend(old_ids[i:])
+    added.extend(new_ids[j:])
+    return added, removed